@@ -2,9 +2,14 @@
 
 """Yahoo API Adapter"""
 
-import logging, requests, urllib.parse
+import logging, random, requests, time, urllib.parse
 import xml.etree.ElementTree as ET
 
+from requests.adapters import HTTPAdapter
+
+from bot.cache import quote_cache
+from bot.providers import QuoteProvider
+
 logger = logging.getLogger('chat-bot')
 
 
@@ -18,7 +23,7 @@ class ApiException(Exception):
         return self.message
 
 
-class YahooFinanceApiAdapter(object):
+class YahooFinanceApiAdapter(QuoteProvider):
     """Yahoo Finance API Adapter"""
 
     BOT_STOCK_URL = 'http://finance.yahoo.com/webservice/v1/symbols/{0}/quote'
@@ -30,11 +35,98 @@ class YahooFinanceApiAdapter(object):
     BOT_USER_AGENT_STR = ('Mozilla/5.0 (Linux; Android 6.0.1; SM-G920V Build/MMB29K) AppleWebKit/537.36 '
                           '(KHTML, like Gecko) Chrome/52.0.2743.98 Mobile Safari/537.36')
 
+    # Status codes for which a request is tried again.
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, cache=None, pool_size=10, connect_timeout=3.05, read_timeout=10, max_retries=2,
+                 backoff_factor=0.5, max_backoff=5):
+        """
+        :param cache: QuoteCache used to store the answers of the API. By default, the cache shared by all
+            the adapters of the process is used.
+        :param pool_size: Maximum number of keep-alive connections kept open to each host.
+        :param connect_timeout: Seconds to wait for a connection to the API to be established.
+        :param read_timeout: Seconds to wait for the API to send data once connected.
+        :param max_retries: Number of times a failed request is tried again.
+        :param backoff_factor: Base number of seconds to wait before retrying. The wait doubles on each
+            attempt and is randomized to avoid retrying in lockstep with other bots.
+        :param max_backoff: Maximum number of seconds to wait between attempts.
+        """
+        self.cache = cache if cache is not None else quote_cache
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.BOT_USER_AGENT_STR
+        http_adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', http_adapter)
+        self.session.mount('https://', http_adapter)
+
+    def close(self):
+        self.session.close()
+
     def query_stock(self, company_code):
+        # Company codes are not case sensitive, so they are cached and queried in upper case.
+        key = company_code.upper()
+        return self.cache.get_or_load('stock', key, lambda: self._fetch_stock(key))
+
+    def query_day_range(self, args):
+        """This method queries the  Yahoo! Finance API to get stock ranges. Quotes found in the cache are
+        not requested again, the rest are queried in a single call to the API.
+        :param args: Company code to query, or a list of company codes.
+        """
+        if not args:
+            raise ApiException('Company code not provided.', code='BOT01')
+
+        codes = list(args) if isinstance(args, (list, tuple)) else [args]
+        # Company codes are not case sensitive, so they are cached in upper case.
+        keys = [code.upper() for code in codes]
+        cached = self.cache.get_many('day_range', keys, refresh=self._refresh_day_ranges)
+        missing = []
+
+        for key in keys:
+            if key not in cached and key not in missing:
+                missing.append(key)
+
+        if missing:
+            fetched = self._fetch_day_ranges(missing)
+            for key in missing:
+                result = fetched.get(key, None)
+                # Errors are not cached, the information could be available in the next call.
+                if result is not None and not result['error']:
+                    self.cache.put('day_range', key, result)
+                cached[key] = result
+
+        return {'error': False, 'results': [cached[key] or self._not_found(code)
+                                            for code, key in zip(codes, keys)]}
+
+    def _fetch_day_ranges(self, keys):
+        """
+        Queries the ranges of the given company codes in a single call to the API. Returns a dictionary
+        with the results, by company code in upper case.
+        """
+        fetched = {}
+
+        for result in self._fetch_day_range(keys)['results']:
+            code = result.get('companyCode', None)
+            if code is not None:
+                fetched[code.upper()] = result
+
+        return fetched
+
+    def _refresh_day_ranges(self, keys):
+        return dict((key, result) for key, result in self._fetch_day_ranges(keys).items()
+                    if not result['error'])
+
+    @staticmethod
+    def _not_found(code):
+        return {'error': True, 'companyCode': code,
+                'message': 'Could not find information for company {0}'.format(code)}
+
+    def _fetch_stock(self, company_code):
         try:
-            api_response = requests.get(self.BOT_STOCK_URL.format(urllib.parse.quote(company_code)),
-                                        headers={'User-Agent': self.BOT_USER_AGENT_STR})
-            api_response.raise_for_status()
+            api_response = self._request_stock(company_code)
             doc = ET.ElementTree(ET.fromstring(api_response.text))
 
             resource = doc.findall('.//resource')
@@ -59,61 +151,123 @@ class YahooFinanceApiAdapter(object):
             msg = 'Error when querying Stock API for company {0}.'.format(company_code)
             raise ApiException(msg, code='BOT03') from e
 
-    def query_day_range(self, args):
-        """This method queries the  Yahoo! Finance API to get stock ranges.
-        :param args: Company code to query, or a list of company codes.
+    def _request_stock(self, company_code):
+        return self._get(self.BOT_STOCK_URL.format(urllib.parse.quote(company_code)))
+
+    def _request_day_range(self, query_codes):
+        return self._get(self.BOT_RANGE_URL.format(urllib.parse.quote(query_codes)), stream=True)
+
+    def _get(self, url, stream=False):
         """
-        if not args:
-            raise ApiException('Company code not provided.', code='BOT01')
+        Makes a GET request through the connection pool of the adapter. Connection errors, timeouts and
+        5xx answers are retried up to max_retries times, waiting between attempts with jittered
+        exponential backoff.
+        """
+        attempt = 0
 
-        if isinstance(args, (list, tuple)):
-            query_codes = ','.join(['"{0}"'.format(code) for code in args])
-        else:
-            query_codes = '"{0}"'.format(args)
+        while True:
+            try:
+                api_response = self.session.get(url, timeout=self.timeout, stream=stream)
+                if api_response.status_code < 400:
+                    return api_response
+                # The connection of an error answer is released to the pool, even when it was not read.
+                api_response.close()
+                if api_response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    api_response.raise_for_status()
+                logger.warning('Yahoo API answered with status %d (attempt %d).', api_response.status_code,
+                               attempt + 1)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning('Error connecting to Yahoo API (attempt %d): %s', attempt + 1, e)
 
-        try:
-            api_response = requests.get(self.BOT_RANGE_URL.format(urllib.parse.quote(query_codes)))
-            api_response.raise_for_status()
-            doc = ET.ElementTree(ET.fromstring(api_response.text))
+            time.sleep(self._backoff(attempt))
+            attempt += 1
 
-            quotes = doc.findall('.//quote')
+    def _backoff(self, attempt):
+        # "Full jitter": wait a random time between 0 and the exponential backoff for the attempt.
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * (2 ** attempt)))
 
-            if not quotes:
-                logger.error('Unexpected response from Yahoo Ranges API', api_response.text)
-                raise ApiException('Unexpected response from Yahoo Ranges API')
+    def iter_day_range(self, codes):
+        """
+        Queries the Yahoo! Finance API for the ranges of the given list of company codes, and yields the
+        result of each company as soon as it is parsed. The response is parsed from the network stream and
+        each quote is discarded after use, so memory doesn't grow with the number of companies. Results
+        are not cached.
+        """
+        query_codes = ','.join(['"{0}"'.format(code) for code in codes])
+        msg = 'Error getting data from Yahoo Finance Ranges API for company {0}.'.format(query_codes)
+
+        try:
+            api_response = self._request_day_range(query_codes)
+        except Exception as e:
+            raise ApiException(msg, code='BOT03') from e
+
+        try:
+            # Let urllib3 decompress the body if it was sent gzipped.
+            api_response.raw.decode_content = True
+            count = 0
 
-            # This API always returns a result, even when the code is incorrect. We can check if the
-            # company code is valid by inspecting certain fields in the answer. If they are empty,
-            # we assume there is no information associated with the company ID given.
-            msg_pattern = '{0} ({1}) Days Low quote is ${2} and Days High is ${3}.'
-            results = []
-
-            for quote in quotes:
-                try:
-                    comp_name = quote.find('Name').text
-                    days_low = quote.find('DaysLow').text
-                    days_high = quote.find('DaysHigh').text
-                    code = quote.attrib['symbol']
-
-                    if not (comp_name and days_low and days_high and code):
-                        logger.error('Error getting information from Yahoo Finance Ranges API: '
-                                     + repr((code, comp_name, days_low, days_high)))
-                        results.append({'error': True, 'message': 'Could not find information '
-                                                                  'for company {0}'.format(code)})
-                        continue
-
-                    results.append({'companyCode': code, 'name': comp_name, 'error': False, 'lang': 'en',
-                                    'daysLow': float(days_low), 'daysHigh': float(days_high),
-                                    'message': msg_pattern.format(code, comp_name, days_low, days_high)})
-                except (IndexError, TypeError, ValueError, AttributeError) as e:
-                    logger.error('Error getting data for company {0}'.format(
-                        quote.attrib.get('symbol', '""')))
-                    logger.exception(e)
-                    results.append({'error': True, 'message': 'Error getting data for company {0}'
-                                   .format(quote.attrib['symbol'])})
-
-            return {'error': False, 'results': results}
+            for result in self._parse_quotes(api_response.raw):
+                count += 1
+                yield result
 
+            if not count:
+                logger.error('Unexpected response from Yahoo Ranges API for %s', query_codes)
+                raise ApiException('Unexpected response from Yahoo Ranges API')
         except Exception as e:
-            msg = 'Error getting data from Yahoo Finance Ranges API for company {0}.'.format(query_codes)
             raise ApiException(msg, code='BOT03') from e
+        finally:
+            api_response.close()
+
+    def _fetch_day_range(self, codes):
+        """Queries the Yahoo! Finance API for the ranges of the given list of company codes."""
+        return {'error': False, 'results': list(self.iter_day_range(codes))}
+
+    def _parse_quotes(self, source):
+        """
+        Parses incrementally the quote elements of a response of the Ranges API read from the file-like
+        object source, and yields their results.
+        """
+        parents = []
+
+        for event, element in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(element)
+                continue
+
+            parents.pop()
+
+            if element.tag == 'quote':
+                yield self._parse_quote(element)
+                # Free the quote once it was used.
+                element.clear()
+                if parents:
+                    parents[-1].remove(element)
+
+    def _parse_quote(self, quote):
+        # This API always returns a result, even when the code is incorrect. We can check if the
+        # company code is valid by inspecting certain fields in the answer. If they are empty,
+        # we assume there is no information associated with the company ID given.
+        msg_pattern = '{0} ({1}) Days Low quote is ${2} and Days High is ${3}.'
+
+        try:
+            comp_name = quote.find('Name').text
+            days_low = quote.find('DaysLow').text
+            days_high = quote.find('DaysHigh').text
+            code = quote.attrib['symbol']
+
+            if not (comp_name and days_low and days_high and code):
+                logger.error('Error getting information from Yahoo Finance Ranges API: '
+                             + repr((code, comp_name, days_low, days_high)))
+                return {'error': True, 'companyCode': code,
+                        'message': 'Could not find information for company {0}'.format(code)}
+
+            return {'companyCode': code, 'name': comp_name, 'error': False, 'lang': 'en',
+                    'daysLow': float(days_low), 'daysHigh': float(days_high),
+                    'message': msg_pattern.format(code, comp_name, days_low, days_high)}
+        except (IndexError, TypeError, ValueError, AttributeError, KeyError) as e:
+            logger.error('Error getting data for company {0}'.format(quote.attrib.get('symbol', '""')))
+            logger.exception(e)
+            return {'error': True, 'companyCode': quote.attrib.get('symbol', None),
+                    'message': 'Error getting data for company {0}'.format(quote.attrib.get('symbol', '""'))}
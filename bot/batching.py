@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+"""Micro-batching of the day range queries sent to the Yahoo! Finance API."""
+
+import logging, threading
+
+from bot.api_adapter import ApiException
+
+logger = logging.getLogger('chat-bot')
+
+
+class _PendingRequest(object):
+
+    def __init__(self, codes):
+        self.codes = codes
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class DayRangeBatcher(object):
+    """
+    Collects the day range requests received during a short window and queries all their companies with a
+    single call to the API. Each request gets back a response with the results of its own companies, in the
+    same format returned by YahooFinanceApiAdapter.query_day_range.
+    """
+
+    def __init__(self, api_adapter, window=0.05, max_symbols=50):
+        """
+        :param api_adapter: Adapter used to query the API.
+        :param window: Seconds to wait for more requests after the first request of a batch arrives.
+        :param max_symbols: The batch is sent before the window ends when it reaches this number of
+            different companies.
+        """
+        self.api_adapter = api_adapter
+        self.window = window
+        self.max_symbols = max_symbols
+        self._lock = threading.Lock()
+        self._pending = []
+        self._symbols = set()
+        self._timer = None
+        self.batches = 0
+        self.requests = 0
+
+    def query_day_range(self, args):
+        """Queues the request in the current batch and waits for its response."""
+        if not args:
+            raise ApiException('Company code not provided.', code='BOT01')
+
+        request = _PendingRequest(list(args) if isinstance(args, (list, tuple)) else [args])
+
+        with self._lock:
+            self._pending.append(request)
+            self._symbols.update(code.upper() for code in request.codes)
+            self.requests += 1
+
+            if len(self._symbols) >= self.max_symbols:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if batch:
+            self._send_batch(batch)
+
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take_batch()
+        self._send_batch(batch)
+
+    def _take_batch(self):
+        """Returns the pending requests and starts a new batch. The lock must be held by the caller."""
+        batch, self._pending, self._symbols = self._pending, [], set()
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        return batch
+
+    def _send_batch(self, batch):
+        if not batch:
+            return
+
+        symbols = []
+        seen = set()
+
+        for request in batch:
+            for code in request.codes:
+                if code.upper() not in seen:
+                    seen.add(code.upper())
+                    symbols.append(code)
+
+        logger.debug('Querying day ranges of %d companies for %d requests.', len(symbols), len(batch))
+        self.batches += 1
+
+        try:
+            # The adapter returns one result per company, in the same order they were requested.
+            results = self.api_adapter.query_day_range(symbols)['results']
+            by_code = {code.upper(): result for code, result in zip(symbols, results)}
+
+            for request in batch:
+                request.response = {'error': False,
+                                    'results': [by_code[code.upper()] for code in request.codes]}
+        except ApiException as e:
+            for request in batch:
+                request.error = e
+        except Exception as e:
+            logger.error('Error querying a batch of day ranges.')
+            logger.exception(e)
+            for request in batch:
+                request.error = ApiException('Error getting data from Yahoo Finance Ranges API.',
+                                             code='BOT03')
+        finally:
+            for request in batch:
+                request.done.set()
@@ -0,0 +1,172 @@
+# encoding: utf-8
+
+"""In-memory cache for quotes returned by the Yahoo! Finance API."""
+
+import logging, threading, time
+
+from collections import OrderedDict
+
+logger = logging.getLogger('chat-bot')
+
+
+class QuoteCache(object):
+    """
+    Size bounded LRU cache shared by all the API adapters of a bot process. Each entry lives for the TTL
+    configured for its kind of command. Once the TTL expires, the entry can still be served during a grace
+    period while a background thread refreshes it, so users don't have to wait for the upstream API.
+    """
+
+    DEFAULT_TTLS = {'stock': 15, 'day_range': 60}
+
+    def __init__(self, max_entries=1024, ttls=None, stale_ttl=30, clock=time.monotonic):
+        """
+        :param max_entries: Maximum number of entries kept in the cache. The least recently used entry is
+            evicted when a new one doesn't fit.
+        :param ttls: Dictionary with the number of seconds an entry is fresh, by kind of command.
+        :param stale_ttl: Number of seconds after the TTL expires in which an entry is still served while
+            it is refreshed in background. Use 0 to disable stale-while-revalidate.
+        :param clock: Function that returns the current time in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttls = dict(self.DEFAULT_TTLS)
+        self.ttls.update(ttls or {})
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+
+    def get(self, kind, key, refresh=None):
+        """
+        Returns the cached value for the given key, or None if it is not in the cache or it has expired.
+        :param kind: Kind of command (stock, day_range), used to choose the TTL of the entry.
+        :param key: Key of the entry, unique within its kind.
+        :param refresh: Function without arguments that loads the value again. It is called in a background
+            thread when a stale entry is served.
+        """
+        with self._lock:
+            value, start_refresh = self._lookup(kind, key, self._clock(), refresh is not None)
+
+        if start_refresh:
+            self._start_refresh(kind, [key], lambda keys: {key: refresh()})
+
+        return value
+
+    def get_many(self, kind, keys, refresh=None):
+        """
+        Returns a dictionary with the cached values of the given keys. Keys that are not in the cache or
+        have expired are left out.
+        :param refresh: Function that receives a list of keys and returns a dictionary with their new
+            values. The stale entries served are refreshed together, with a single call in a background
+            thread.
+        """
+        now = self._clock()
+        values = {}
+        stale = []
+
+        with self._lock:
+            for key in keys:
+                value, start_refresh = self._lookup(kind, key, now, refresh is not None)
+                if value is not None:
+                    values[key] = value
+                if start_refresh:
+                    stale.append(key)
+
+        if stale:
+            self._start_refresh(kind, stale, refresh)
+
+        return values
+
+    def _lookup(self, kind, key, now, can_refresh):
+        """
+        Returns the cached value of the key, and whether a refresh of the entry must be started. Must be
+        called holding the lock.
+        """
+        cache_key = (kind, key)
+        entry = self._entries.get(cache_key, None)
+
+        if entry is None:
+            self.misses += 1
+            return None, False
+
+        value, stored_at = entry
+        age = now - stored_at
+        ttl = self.ttls.get(kind, 0)
+
+        if age < ttl:
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return value, False
+
+        if age >= ttl + self.stale_ttl or not can_refresh:
+            del self._entries[cache_key]
+            self.misses += 1
+            return None, False
+
+        self._entries.move_to_end(cache_key)
+        self.stale_hits += 1
+        if cache_key in self._refreshing:
+            return value, False
+        self._refreshing.add(cache_key)
+        return value, True
+
+    def put(self, kind, key, value):
+        cache_key = (kind, key)
+
+        with self._lock:
+            self._entries[cache_key] = (value, self._clock())
+            self._entries.move_to_end(cache_key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, kind, key, loader):
+        """Returns the cached value for the key, calling loader and storing its result on a cache miss."""
+        value = self.get(kind, key, refresh=loader)
+
+        if value is None:
+            value = loader()
+            self.put(kind, key, value)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the counters of the cache, useful to tune its size and TTLs."""
+        with self._lock:
+            return {'size': len(self._entries), 'maxEntries': self.max_entries, 'hits': self.hits,
+                    'staleHits': self.stale_hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'refreshErrors': self.refresh_errors}
+
+    def _start_refresh(self, kind, keys, loader):
+        t = threading.Thread(target=self._refresh, args=(kind, keys, loader), name='quote-cache-refresh',
+                             daemon=True)
+        t.start()
+
+    def _refresh(self, kind, keys, loader):
+        try:
+            for key, value in loader(keys).items():
+                self.put(kind, key, value)
+        except Exception as e:
+            # The stale entries stay in place until they expire completely.
+            logger.error('Error refreshing cached quotes %r.', [(kind, key) for key in keys])
+            logger.exception(e)
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._refreshing.discard((kind, key))
+
+
+# Cache shared by all the API adapters of the process.
+quote_cache = QuoteCache()
@@ -0,0 +1,126 @@
+# encoding: utf-8
+
+"""Quote provider that serves recorded answers of the Yahoo! Finance API, for tests and benchmarks."""
+
+import io, logging, os, random, re, requests, threading, time
+import xml.etree.ElementTree as ET
+
+from bot.api_adapter import YahooFinanceApiAdapter
+
+logger = logging.getLogger('chat-bot')
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class _FakeResponse(object):
+    """Mimics the parts of requests.Response used by YahooFinanceApiAdapter."""
+
+    def __init__(self, content):
+        self.status_code = 200
+        self.text = content.decode('utf-8')
+        self.raw = io.BytesIO(content)
+
+    def close(self):
+        self.raw.close()
+
+
+class FakeDelivery(object):
+    """Delivery information of a message, like the one pika passes to the consumers of the bot."""
+
+    def __init__(self, delivery_tag=0):
+        self.delivery_tag = delivery_tag
+
+
+class FakeProperties(object):
+    """Properties of a message, like the ones pika passes to the consumers of the bot."""
+
+    def __init__(self, correlation_id=None):
+        self.correlation_id = correlation_id
+
+
+class FakeChannel(object):
+    """Replaces the channel of a bot fed without RabbitMQ, counting the messages acknowledged."""
+
+    def __init__(self):
+        self.acks = 0
+        self.nacks = 0
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acks += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacks += 1
+
+
+class FakeQuoteProvider(YahooFinanceApiAdapter):
+    """
+    Works like YahooFinanceApiAdapter, including its cache and parsing of the answers, but the XML
+    documents are built from the recorded answers in the fixtures directory instead of being requested to
+    the API. Unknown companies get the same empty answers the real API returns. The latency and the rate of
+    failed requests are configurable, and failures are deterministic for a given seed.
+    """
+
+    def __init__(self, cache=None, latency=0, error_rate=0, seed=0, fixtures_dir=FIXTURES_DIR, **kwargs):
+        """
+        :param cache: QuoteCache used to store the answers, like in YahooFinanceApiAdapter.
+        :param latency: Seconds each request to the fake API takes.
+        :param error_rate: Fraction of requests, between 0 and 1, that fail with a connection error.
+        :param seed: Seed of the random generator that decides which requests fail.
+        :param fixtures_dir: Directory with the files stock_quotes.xml and day_ranges.xml.
+        """
+        kwargs.setdefault('max_retries', 0)
+        super(FakeQuoteProvider, self).__init__(cache=cache, **kwargs)
+        self.latency = latency
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.requests = 0
+
+        stock_doc = ET.parse(os.path.join(fixtures_dir, 'stock_quotes.xml'))
+        self._stock_resources = {}
+        for resource in stock_doc.iter('resource'):
+            symbol = resource.find('field[@name="symbol"]').text
+            self._stock_resources[symbol.upper()] = resource
+
+        range_doc = ET.parse(os.path.join(fixtures_dir, 'day_ranges.xml'))
+        self._range_quotes = {quote.attrib['symbol'].upper(): quote for quote in range_doc.iter('quote')}
+
+    def _request_stock(self, company_code):
+        self._simulate_request()
+        root = ET.Element('list', version='1.0')
+        resources = ET.SubElement(root, 'resources')
+        resource = self._stock_resources.get(company_code.upper(), None)
+
+        if resource is not None:
+            resources.append(resource)
+
+        return _FakeResponse(ET.tostring(root, encoding='utf-8'))
+
+    def _request_day_range(self, query_codes):
+        self._simulate_request()
+        root = ET.Element('query')
+        results = ET.SubElement(root, 'results')
+
+        for code in re.findall(r'"([^"]*)"', query_codes):
+            quote = self._range_quotes.get(code.upper(), None)
+
+            if quote is None:
+                # The API answers with an empty quote when the company doesn't exist.
+                quote = ET.Element('quote', symbol=code)
+                for tag in ('Name', 'DaysLow', 'DaysHigh'):
+                    ET.SubElement(quote, tag)
+
+            results.append(quote)
+
+        return _FakeResponse(ET.tostring(root, encoding='utf-8'))
+
+    def _simulate_request(self):
+        with self._random_lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if fail:
+            raise requests.ConnectionError('Simulated error of the fake quote provider.')
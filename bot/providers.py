@@ -0,0 +1,44 @@
+# encoding: utf-8
+
+"""Interface of the services the bot uses to get quotes, and registry of the available implementations."""
+
+import abc, importlib
+
+# Providers that can be selected by name in the bot configuration.
+PROVIDERS = {
+    'yahoo': 'bot.api_adapter.YahooFinanceApiAdapter',
+    'fake': 'bot.fake_provider.FakeQuoteProvider',
+}
+
+
+class QuoteProvider(abc.ABC):
+    """
+    Service that answers the commands of the bot. Implementations return the same response objects, and
+    raise ApiException when a query cannot be answered.
+    """
+
+    @abc.abstractmethod
+    def query_stock(self, company_code):
+        """Returns the quote of the given company."""
+
+    @abc.abstractmethod
+    def query_day_range(self, args):
+        """
+        Returns the days low and days high quotes of a company.
+        :param args: Company code to query, or a list of company codes.
+        """
+
+    def close(self):
+        """Releases the resources used by the provider."""
+        pass
+
+
+def create_provider(name, **options):
+    """Creates the provider registered with the given name, passing options to its constructor."""
+    try:
+        module_name, class_name = PROVIDERS[name].rsplit('.', 1)
+    except KeyError:
+        raise ValueError('Unknown quote provider: {0}'.format(name))
+
+    provider_class = getattr(importlib.import_module(module_name), class_name)
+    return provider_class(**options)
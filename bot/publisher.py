@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+"""Publisher of the bot's responses to RabbitMQ."""
+
+import logging, pika
+
+logger = logging.getLogger('chat-bot')
+
+
+class ResponsePublisher(object):
+    """
+    Keeps a single connection and channel open to publish the responses of the bot. The connection is
+    opened on the first publish and opened again if it is lost. It is not thread safe: it must be used
+    from the thread that runs the bot's consumer loop.
+    """
+
+    def __init__(self, host='localhost', queue='bot_responses', confirm=False, app_id='bot'):
+        """
+        :param host: RabbitMQ host.
+        :param queue: Queue where responses are published.
+        :param confirm: If True, waits for the broker to confirm the responses were stored. Responses
+            published together with publish_batch are confirmed in a single round trip.
+        :param app_id: Value of the app_id property of the published messages.
+        """
+        self.host = host
+        self.queue = queue
+        self.confirm = confirm
+        self.app_id = app_id
+        self._connection = None
+        self._channel = None
+
+    def publish(self, body, correlation_id):
+        self.publish_batch([(body, correlation_id)])
+
+    def publish_batch(self, messages):
+        """
+        Publishes a list of (body, correlation_id) tuples. If the connection was lost, it is opened again
+        and the batch is published once more.
+        """
+        if not messages:
+            return
+
+        for attempt in (1, 2):
+            try:
+                channel = self._get_channel()
+
+                for body, correlation_id in messages:
+                    channel.basic_publish(exchange='', routing_key=self.queue, body=body,
+                                          properties=pika.BasicProperties(content_type='application/json',
+                                                                          correlation_id=correlation_id,
+                                                                          app_id=self.app_id))
+                if self.confirm:
+                    # pika's blocking confirm mode waits for each message. A transaction confirms the
+                    # whole batch with one commit instead.
+                    channel.tx_commit()
+                return
+            except pika.exceptions.AMQPError as e:
+                self.close()
+                if attempt == 2:
+                    raise
+                logger.warning('Connection to RabbitMQ lost while publishing responses (%s). Reconnecting...',
+                               e)
+
+    def keepalive(self):
+        """Processes the heartbeats of the connection. Must be called regularly while the bot is idle."""
+        if self._connection is None:
+            return
+
+        try:
+            self._connection.process_data_events(time_limit=0)
+        except pika.exceptions.AMQPError as e:
+            logger.warning('Publisher connection to RabbitMQ lost (%s).', e)
+            self.close()
+
+    def close(self):
+        connection, self._connection, self._channel = self._connection, None, None
+
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def _get_channel(self):
+        if self._channel is None or not self._channel.is_open:
+            self.close()
+            self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=self.host))
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self.queue)
+            if self.confirm:
+                self._channel.tx_select()
+        return self._channel
@@ -2,97 +2,250 @@
 
 """Bot's main class. It processes messages received from the bot_requests queue from RabbitMQ"""
 
-import json, logging, pika
+import json, logging, pika, queue
+
+from concurrent.futures import ThreadPoolExecutor
 
 from bot.api_adapter import ApiException, YahooFinanceApiAdapter
+from bot.batching import DayRangeBatcher
+from bot.publisher import ResponsePublisher
+from bot.singleflight import SingleFlight
 
 logger = logging.getLogger('chat-bot')
 
 
 class Bot(object):
 
-    def __init__(self, configure_message_bus=True):
-        # The parameter configure_message_bus = False allows to create a bot instance without connecting
-        # to RabbitMQ, useful for testing Yahoo API calls.
+    # Maximum number of seconds the consumer loop waits for new messages before sending the responses
+    # completed by the worker threads.
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, configure_message_bus=True, api_adapter=None, concurrency=1, prefetch_count=None,
+                 worker_id=None, publish_confirms=False, day_range_window=0, day_range_max_symbols=50):
+        """
+        :param configure_message_bus: False allows to create a bot instance without connecting to RabbitMQ,
+            useful for testing Yahoo API calls.
+        :param api_adapter: Adapter used to query the Yahoo API.
+        :param concurrency: Number of requests processed in parallel. With a value greater than 1, the
+            requests are processed by a pool of threads and acknowledged after their response is sent.
+        :param prefetch_count: Number of unacknowledged messages RabbitMQ delivers to the bot. By default,
+            it is twice the concurrency, so the workers don't wait for new messages.
+        :param worker_id: Number of the worker process when the bot runs under a BotSupervisor. It is sent
+            in the app_id property of the responses, to know which worker handled each message.
+        :param publish_confirms: If True, the bot waits for RabbitMQ to confirm its responses were stored.
+            The responses completed at the same time are confirmed together.
+        :param day_range_window: Seconds during which day range requests are collected to query all their
+            companies with a single call to the API. 0 disables batching. Only useful with concurrency > 1.
+        :param day_range_max_symbols: Maximum number of companies queried in a batch of day range requests.
+        """
         self._configure_message_bus = configure_message_bus
+        # A single adapter is used for the life of the bot, so its HTTP connections are reused.
+        self.api_adapter = api_adapter if api_adapter is not None else YahooFinanceApiAdapter()
+        self.concurrency = max(1, concurrency)
+        self._executor = None
+        self._completed = queue.Queue()
+        self._running = False
+        self.worker_id = worker_id
+        self.app_id = 'bot' if worker_id is None else 'bot-worker-{0}'.format(worker_id)
+        # Responses are published through a connection that stays open for the life of the bot.
+        self.publisher = ResponsePublisher(confirm=publish_confirms, app_id=self.app_id)
+        self._single_flight = SingleFlight()
+
+        if day_range_window > 0:
+            self._day_range_source = DayRangeBatcher(self.api_adapter, window=day_range_window,
+                                                     max_symbols=day_range_max_symbols)
+        else:
+            self._day_range_source = self.api_adapter
+
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
 
         if not self._configure_message_bus:
             return
 
+        if prefetch_count is None:
+            prefetch_count = 1 if self.concurrency == 1 else self.concurrency * 2
+
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
         self.channel = self.connection.channel()
         self.channel.queue_declare(queue='bot_requests')
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(self._process_request, queue='bot_requests', no_ack=True)
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+
+        if self._executor:
+            self.channel.basic_consume(self._dispatch_request, queue='bot_requests', no_ack=False)
+        else:
+            self.channel.basic_consume(self._process_request, queue='bot_requests', no_ack=True)
 
     def start(self):
         if not self._configure_message_bus:
             raise ValueError('Bot cannot start when instanciated with argument configure_message_bus=False.')
 
-        logger.info('Bot started. Waiting for incomming connections...')
-        self.channel.start_consuming()
+        logger.info('Bot %s started (concurrency=%d). Waiting for incomming connections...', self.app_id,
+                    self.concurrency)
+        self._running = True
+
+        try:
+            while self._running:
+                self.connection.process_data_events(time_limit=self.POLL_INTERVAL)
+                self._send_completed_responses()
+        finally:
+            if self._executor:
+                self._executor.shutdown(wait=True)
+                self._send_completed_responses()
+            # Unacknowledged requests are delivered again to another bot.
+            self.publisher.close()
+            self.api_adapter.close()
+            self.connection.close()
+            logger.info('Bot %s stopped.', self.app_id)
+
+    def stop(self):
+        """Stops the bot after the current iteration of the consumer loop. Safe to use in signal handlers."""
+        self._running = False
 
     def _process_request(self, ch, method, props, body):
+        self._send_response(self._handle_request(props, body), props.correlation_id)
+
+    def _dispatch_request(self, ch, method, props, body):
+        """Sends the request to the pool of workers. Its response is sent later by the consumer thread."""
+        future = self._executor.submit(self._handle_request, props, body)
+        future.add_done_callback(
+            lambda f: self._completed.put((method.delivery_tag, props.correlation_id, f)))
+
+    def _send_completed_responses(self):
+        """
+        Sends the responses of the requests completed by the workers in a single batch, and acknowledges
+        them. This must run in the consumer thread, because pika connections are not thread safe. Requests
+        can complete in any order, each response is matched with its request by the correlation id.
+        """
+        completed = []
+
+        while True:
+            try:
+                delivery_tag, correlation_id, future = self._completed.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                response_obj = future.result()
+            except Exception as e:
+                logger.error('Error processing message (corr_id=%s).', correlation_id)
+                logger.exception(e)
+                response_obj = Bot._create_error_response('Error processing the request.', code='BOT03')
+
+            completed.append((delivery_tag, self._serialize_response(response_obj, correlation_id),
+                              correlation_id))
+
+        if not completed:
+            self.publisher.keepalive()
+            return
+
+        try:
+            self.publisher.publish_batch([(str_json, corr_id) for _, str_json, corr_id in completed])
+        except Exception as e:
+            # The requests go back to the queue, so they are processed again later.
+            logger.error('FATAL: Cannot return answers from bot.')
+            logger.exception(e)
+            for delivery_tag, _, _ in completed:
+                self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+            return
+
+        for delivery_tag, _, _ in completed:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+
+    def _handle_request(self, props, body):
+        """Processes a request sent to the bot, and returns the response object that must be sent back."""
         # Message is expected in JSON format.
-        logger.debug('Message (corr_id=%s) received by the bot: %r', props.correlation_id, body)
+        logger.debug('Message (corr_id=%s) received by %s: %r', props.correlation_id, self.app_id, body)
         try:
-            content = json.loads(body.decode(), 'utf-8')
+            content = json.loads(body.decode('utf-8'))
         except Exception as e:
             logger.error('Error parsing message sent to bot.')
             logger.exception(e)
-            self._send_response(Bot._create_error_response('Error when deserializing message received '
-                                                           'by the bot.', code='BOT03'), props.correlation_id)
-            return
+            return Bot._create_error_response('Error when deserializing message received by the bot.',
+                                              code='BOT03')
 
         if not isinstance(content, dict):
-            self._send_response(Bot._create_error_response('Message is not a valid JSON object.',
-                                                           code='BOT03'), props.correlation_id)
-            return
+            return Bot._create_error_response('Message is not a valid JSON object.', code='BOT03')
+
+        try:
+            return self._answer_request(content)
+        except Exception as e:
+            logger.error('Error processing message (corr_id=%s).', props.correlation_id)
+            logger.exception(e)
+            return Bot._create_error_response('Error processing the request.', code='BOT03')
+
+    def _answer_request(self, content):
+        api_adapter = self.api_adapter
+        command_type = content.get('type', None)
+        arg = Bot._normalize_arg(content.get('arg', None))
 
-        api_adapter = YahooFinanceApiAdapter()
+        if command_type in ('stock', 'day_range') and not Bot._is_valid_arg(arg):
+            return Bot._create_error_response('Company code must be a string or a list of strings.',
+                                              code='BOT03')
 
-        if content['type'] == 'stock':
+        # Identical requests in progress at the same time share a single call to the API.
+        key = (command_type, Bot._request_key(arg))
+
+        if command_type == 'stock':
             try:
-                response_obj = api_adapter.query_stock(content.get('arg', None))
+                response_obj = self._single_flight.do(key, lambda: api_adapter.query_stock(arg))
             except ApiException as e:
                 logger.exception(e)
                 response_obj = self._create_error_response(e.message, e.code)
-        elif content['type'] == 'day_range':
+        elif command_type == 'day_range':
             try:
-                response_obj = api_adapter.query_day_range(content.get('arg', None))
+                response_obj = self._single_flight.do(key,
+                                                      lambda: self._day_range_source.query_day_range(arg))
             except ApiException as e:
                 logger.exception(e)
                 response_obj = self._create_error_response(e.message, e.code)
         else:
             response_obj = Bot._create_error_response('Service not implemented: {0}'
-                                                      .format(content['type']))
+                                                      .format(command_type))
 
-        self._send_response(response_obj, props.correlation_id)
+        return response_obj
 
     def _send_response(self, json_response, correlation_id):
-        connection = None
         try:
-            connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-            channel = connection.channel()
-            channel.queue_declare(queue='bot_responses')
-
-            try:
-                str_json = json.dumps(json_response)
-            except (TypeError, ValueError) as e:
-                logger.error('Error serializing response to json.')
-                logger.exception(e)
-                str_json = json.dumps(Bot._create_error_response('Non serializable response.', code='BOT02'))
-
-            logger.debug('Bot sends response (corr_id=%s): %s', correlation_id, str_json)
-            channel.basic_publish(exchange='', routing_key='bot_responses', body=str_json,
-                                  properties=pika.BasicProperties(content_type='application/json',
-                                                                  correlation_id=correlation_id))
+            self.publisher.publish(self._serialize_response(json_response, correlation_id), correlation_id)
         except Exception as e:
             logger.error('FATAL: Cannot return answer from bot.')
             logger.exception(e)
-        finally:
-            if connection:
-                connection.close()
+
+    def _serialize_response(self, json_response, correlation_id):
+        try:
+            str_json = json.dumps(json_response)
+        except (TypeError, ValueError) as e:
+            logger.error('Error serializing response to json.')
+            logger.exception(e)
+            str_json = json.dumps(Bot._create_error_response('Non serializable response.', code='BOT02'))
+
+        logger.debug('%s sends response (corr_id=%s): %s', self.app_id, correlation_id, str_json)
+        return str_json
+
+    @staticmethod
+    def _normalize_arg(arg):
+        if isinstance(arg, str):
+            return arg.strip()
+        if isinstance(arg, (list, tuple)):
+            return [code.strip() if isinstance(code, str) else code for code in arg]
+        return arg
+
+    @staticmethod
+    def _is_valid_arg(arg):
+        """Missing args are accepted, the API adapter answers them with an error."""
+        if arg is None or isinstance(arg, str):
+            return True
+        return isinstance(arg, list) and all(isinstance(code, str) for code in arg)
+
+    @staticmethod
+    def _request_key(arg):
+        # Company codes are not case sensitive.
+        if isinstance(arg, str):
+            return arg.upper()
+        if isinstance(arg, list):
+            return tuple(code.upper() for code in arg)
+        return arg
 
     @staticmethod
     def _create_error_response(message, code=None):
@@ -0,0 +1,57 @@
+# encoding: utf-8
+
+"""Coalescing of identical calls that are in progress at the same time."""
+
+import threading
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Makes sure only one call for a given key is in progress at a time. Threads that ask for the same key
+    while the call runs wait for it and get its result (or its exception) instead of repeating the call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Calls fn without arguments and returns its result, unless a call for key is already running."""
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
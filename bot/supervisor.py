@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+"""Supervisor that runs several bot processes consuming from the same queue."""
+
+import logging, multiprocessing, os, signal, time
+
+logger = logging.getLogger('chat-bot')
+
+
+def _run_worker(worker_id, bot_factory):
+    """Entry point of a worker process. Builds the bot and consumes until SIGTERM is received."""
+    # Ctrl+C is sent to the whole process group. Only the supervisor handles it, and it stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bot_instance = bot_factory(worker_id=worker_id)
+    signal.signal(signal.SIGTERM, lambda signum, frame: bot_instance.stop())
+    bot_instance.start()
+
+
+class BotSupervisor(object):
+    """
+    Starts a number of bot worker processes, restarts the ones that die, and stops all of them when the
+    supervisor receives SIGTERM or SIGINT.
+    """
+
+    # Seconds between checks of the state of the workers.
+    MONITOR_INTERVAL = 0.5
+
+    # A worker that dies before running this number of seconds is restarted with a growing delay, to
+    # avoid a restart loop when RabbitMQ is down.
+    MIN_UPTIME = 10
+
+    MAX_RESTART_DELAY = 30
+
+    def __init__(self, workers, bot_factory, shutdown_timeout=10):
+        """
+        :param workers: Number of worker processes.
+        :param bot_factory: Callable that receives the keyword argument worker_id and returns a Bot. It is
+            called inside the worker process, so every worker has its own connections.
+        :param shutdown_timeout: Seconds to wait for the workers to finish before killing them.
+        """
+        self.workers = workers
+        self.bot_factory = bot_factory
+        self.shutdown_timeout = shutdown_timeout
+        self._processes = {}
+        self._started_at = {}
+        self._restart_delay = {}
+        self._restart_at = {}
+        self._running = False
+
+    def start(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        self._running = True
+
+        for worker_id in range(1, self.workers + 1):
+            self._start_worker(worker_id)
+
+        logger.info('Bot supervisor started with %d workers.', self.workers)
+
+        try:
+            while self._running:
+                self._check_workers()
+                time.sleep(self.MONITOR_INTERVAL)
+        finally:
+            self._stop_workers()
+
+    def stop(self):
+        self._running = False
+
+    def _handle_signal(self, signum, frame):
+        logger.info('Bot supervisor received signal %d, stopping workers...', signum)
+        self.stop()
+
+    def _start_worker(self, worker_id):
+        process = multiprocessing.Process(target=_run_worker, args=(worker_id, self.bot_factory),
+                                          name='bot-worker-{0}'.format(worker_id))
+        process.start()
+        self._processes[worker_id] = process
+        self._started_at[worker_id] = time.monotonic()
+        self._restart_at.pop(worker_id, None)
+        logger.info('Bot worker %d started (pid=%d).', worker_id, process.pid)
+
+    def _check_workers(self):
+        now = time.monotonic()
+
+        for worker_id, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+
+            if worker_id not in self._restart_at:
+                process.join()
+                uptime = now - self._started_at[worker_id]
+
+                if uptime < self.MIN_UPTIME:
+                    delay = min(self.MAX_RESTART_DELAY, self._restart_delay.get(worker_id, 0.5) * 2)
+                else:
+                    delay = 0
+                self._restart_delay[worker_id] = delay or 0.5
+                self._restart_at[worker_id] = now + delay
+
+                logger.error('Bot worker %d (pid=%d) died with exit code %s. Restarting in %.1f seconds.',
+                             worker_id, process.pid, process.exitcode, delay)
+
+            if now >= self._restart_at[worker_id]:
+                self._start_worker(worker_id)
+
+    def _stop_workers(self):
+        alive = [p for p in self._processes.values() if p.is_alive()]
+
+        for process in alive:
+            process.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+
+        for process in alive:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error('Bot worker %s did not stop in time, killing it.', process.name)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+        logger.info('Bot supervisor stopped.')
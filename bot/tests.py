@@ -2,11 +2,18 @@
 
 """Test cases for the Bot's Yahoo! API calls."""
 
-import unittest
+import io, json, os, pika, signal, threading, time, unittest
 
-from unittest import TestCase
+from unittest import TestCase, mock
 
+from .api_adapter import ApiException, YahooFinanceApiAdapter
+from .batching import DayRangeBatcher
+from .cache import QuoteCache
+from .fake_provider import FakeQuoteProvider
+from .publisher import ResponsePublisher
 from .server import Bot
+from .singleflight import SingleFlight
+from .supervisor import BotSupervisor
 
 
 class BotRequestTest(TestCase):
@@ -108,5 +115,519 @@ class BotRequestTest(TestCase):
         self.assertEqual(response.get('code', None), 'BOT01')
 
 
+class FakeProviderBotTest(TestCase):
+    """Runs the bot's commands against the recorded answers of the fake provider."""
+
+    def setUp(self):
+        self.provider = FakeQuoteProvider(cache=QuoteCache())
+        self.bot = Bot(configure_message_bus=False, api_adapter=self.provider)
+
+    def _request(self, command_type, arg):
+        body = json.dumps({'type': command_type, 'arg': arg}).encode()
+        return self.bot._handle_request(mock.Mock(correlation_id='test'), body)
+
+    def test_stock_existing_company(self):
+        response = self._request('stock', 'AAPL')
+        self.assertFalse(response['error'])
+        self.assertEqual(response['price'], 144.190002)
+        self.assertEqual(response['message'], 'AAPL (Apple Inc.) quote is $144.190002 per share.')
+
+    def test_stock_nonexisting_company(self):
+        response = self._request('stock', 'sfsklgg')
+        self.assertTrue(response['error'])
+        self.assertEqual(response['code'], 'BOT03')
+
+    def test_day_range_multiple_companies(self):
+        response = self._request('day_range', ['AAPL', 'APPL', 'msft'])
+        self.assertFalse(response['error'])
+        results = response['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual((results[0]['daysLow'], results[0]['daysHigh']), (143.47, 144.52))
+        self.assertTrue(results[1]['error'])
+        self.assertEqual(results[2]['companyCode'], 'MSFT')
+
+    def test_day_range_uses_cache(self):
+        self._request('day_range', ['AAPL', 'MSFT'])
+        self._request('day_range', ['MSFT', 'GOOG'])
+        self.assertEqual(self.provider.requests, 2)
+        self.assertEqual(self.provider.cache.stats()['hits'], 1)
+
+    def test_day_range_cache_ignores_case(self):
+        self._request('day_range', ['aapl'])
+        response = self._request('day_range', ['AAPL'])
+        self.assertEqual(response['results'][0]['companyCode'], 'AAPL')
+        self.assertEqual(self.provider.requests, 1)
+
+    def test_stock_cache_ignores_case(self):
+        self._request('stock', 'aapl')
+        response = self._request('stock', 'AAPL')
+        self.assertEqual(response['message'], 'AAPL (Apple Inc.) quote is $144.190002 per share.')
+        self.assertEqual(self.provider.requests, 1)
+        self.assertEqual(self.provider.cache.stats()['hits'], 1)
+
+    def test_stale_day_ranges_are_refreshed_together(self):
+        now = [0]
+        provider = FakeQuoteProvider(cache=QuoteCache(ttls={'day_range': 10}, stale_ttl=10,
+                                                      clock=lambda: now[0]))
+        provider.query_day_range(['AAPL', 'MSFT', 'GOOG'])
+        now[0] = 15
+        response = provider.query_day_range(['AAPL', 'MSFT', 'GOOG'])
+        self.assertEqual(len(response['results']), 3)
+
+        for t in threading.enumerate():
+            if t.name == 'quote-cache-refresh':
+                t.join()
+
+        self.assertEqual(provider.requests, 2)
+        self.assertEqual(provider.cache.stats()['staleHits'], 3)
+
+    def test_errors_are_deterministic(self):
+        provider = FakeQuoteProvider(cache=QuoteCache(max_entries=0), error_rate=0.5, seed=1)
+        outcomes = []
+        for _ in range(10):
+            try:
+                provider.query_stock('AAPL')
+                outcomes.append(True)
+            except ApiException:
+                outcomes.append(False)
+        self.assertIn(True, outcomes)
+        self.assertIn(False, outcomes)
+
+    def test_unknown_command(self):
+        response = self._request('weather', 'Quito')
+        self.assertTrue(response['error'])
+
+    def test_invalid_arg_is_answered_with_error(self):
+        for arg in ({}, [['AAPL']], ['AAPL', {}]):
+            response = self._request('stock', arg)
+            self.assertTrue(response['error'])
+            self.assertEqual(response['code'], 'BOT03')
+
+    def test_connections_are_closed_when_stopped(self):
+        self.provider.close = mock.Mock()
+        self.bot._configure_message_bus = True
+        self.bot.connection = mock.Mock()
+        self.bot.connection.process_data_events.side_effect = lambda time_limit: self.bot.stop()
+        self.bot.publisher = mock.Mock()
+        self.bot.start()
+
+        self.assertTrue(self.bot.publisher.close.called)
+        self.assertTrue(self.provider.close.called)
+        self.assertTrue(self.bot.connection.close.called)
+
+    def test_unexpected_error_is_answered_with_error(self):
+        with mock.patch.object(self.provider, 'query_stock', side_effect=RuntimeError('Broken')):
+            response = self._request('stock', 'AAPL')
+        self.assertTrue(response['error'])
+        self.assertEqual(response['code'], 'BOT03')
+
+
+class QuoteCacheTest(TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = QuoteCache(max_entries=2, ttls={'stock': 10}, stale_ttl=5, clock=lambda: self.now)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('stock', 'AAPL'))
+        self.cache.put('stock', 'AAPL', {'price': 1.0})
+        self.assertEqual(self.cache.get('stock', 'AAPL'), {'price': 1.0})
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.put('stock', 'AAPL', 1)
+        self.cache.put('stock', 'MSFT', 2)
+        self.cache.get('stock', 'AAPL')
+        self.cache.put('stock', 'GOOG', 3)
+        self.assertIsNone(self.cache.get('stock', 'MSFT'))
+        self.assertEqual(self.cache.get('stock', 'AAPL'), 1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_stale_entry_is_served_while_refreshing(self):
+        self.cache.put('stock', 'AAPL', 1)
+        self.now = 12
+        self.assertEqual(self.cache.get_or_load('stock', 'AAPL', lambda: 2), 1)
+        self.assertEqual(self.cache.stats()['staleHits'], 1)
+
+        for t in threading.enumerate():
+            if t.name == 'quote-cache-refresh':
+                t.join()
+
+        self.assertEqual(self.cache.get('stock', 'AAPL'), 2)
+
+    def test_expired_entry_is_loaded_again(self):
+        self.cache.put('stock', 'AAPL', 1)
+        self.now = 20
+        self.assertEqual(self.cache.get_or_load('stock', 'AAPL', lambda: 2), 2)
+
+
+class ApiAdapterRetryTest(TestCase):
+
+    def setUp(self):
+        self.adapter = YahooFinanceApiAdapter(cache=QuoteCache(), connect_timeout=1, read_timeout=2,
+                                              max_retries=2, backoff_factor=0)
+
+    def _response(self, status):
+        response = mock.Mock(status_code=status)
+        if status >= 400:
+            response.raise_for_status.side_effect = Exception('HTTP {0}'.format(status))
+        return response
+
+    def test_retries_server_errors(self):
+        failed, succeeded = self._response(503), self._response(200)
+        with mock.patch.object(self.adapter.session, 'get', side_effect=[failed, succeeded]) as get:
+            self.assertEqual(self.adapter._get('http://example.com').status_code, 200)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(get.call_args[1]['timeout'], (1, 2))
+        self.assertTrue(failed.close.called)
+        self.assertFalse(succeeded.close.called)
+
+    def test_gives_up_after_max_retries(self):
+        responses = [self._response(503) for _ in range(3)]
+        with mock.patch.object(self.adapter.session, 'get', side_effect=responses) as get:
+            self.assertRaises(Exception, self.adapter._get, 'http://example.com', stream=True)
+        self.assertEqual(get.call_count, 3)
+        self.assertTrue(all(r.close.called for r in responses))
+
+    def test_client_errors_are_closed_and_not_retried(self):
+        response = self._response(404)
+        with mock.patch.object(self.adapter.session, 'get', return_value=response) as get:
+            self.assertRaises(Exception, self.adapter._get, 'http://example.com', stream=True)
+        self.assertEqual(get.call_count, 1)
+        self.assertTrue(response.close.called)
+
+
+class StreamingDayRangeTest(TestCase):
+
+    QUOTE = ('<quote symbol="{0}"><Name>{0} Inc.</Name><DaysLow>1.5</DaysLow><DaysHigh>2.5</DaysHigh>'
+             '</quote>')
+
+    def test_quotes_are_parsed_incrementally(self):
+        adapter = YahooFinanceApiAdapter(cache=QuoteCache())
+        quotes = ''.join(self.QUOTE.format('C{0}'.format(i)) for i in range(500))
+        document = '<query><results>{0}<quote symbol="XX"><Name/></quote></results></query>'.format(quotes)
+        results = list(adapter._parse_quotes(io.BytesIO(document.encode())))
+
+        self.assertEqual(len(results), 501)
+        self.assertEqual(results[0]['companyCode'], 'C0')
+        self.assertEqual(results[499]['daysHigh'], 2.5)
+        self.assertFalse(results[499]['error'])
+        self.assertTrue(results[500]['error'])
+        self.assertEqual(results[500]['companyCode'], 'XX')
+
+
+class ConcurrentBotTest(TestCase):
+
+    class SlowAdapter(object):
+
+        def query_stock(self, company_code):
+            # The first requests take longer, so they complete out of order.
+            time.sleep({'A': 0.2, 'B': 0.1}.get(company_code, 0))
+            return {'error': False, 'message': company_code}
+
+    def test_responses_match_correlation_ids(self):
+        bot = Bot(configure_message_bus=False, api_adapter=self.SlowAdapter(), concurrency=3)
+        bot.channel = mock.Mock()
+        bot.publisher = mock.Mock()
+
+        for tag, code in enumerate(['A', 'B', 'C'], start=1):
+            body = json.dumps({'type': 'stock', 'arg': code}).encode()
+            bot._dispatch_request(None, mock.Mock(delivery_tag=tag), mock.Mock(correlation_id='id-' + code),
+                                  body)
+
+        bot._executor.shutdown(wait=True)
+        bot._send_completed_responses()
+
+        batch = bot.publisher.publish_batch.call_args[0][0]
+        sent = [(corr_id, json.loads(body)['message']) for body, corr_id in batch]
+        self.assertEqual(sent, [('id-C', 'C'), ('id-B', 'B'), ('id-A', 'A')])
+        self.assertEqual([c[1]['delivery_tag'] for c in bot.channel.basic_ack.call_args_list], [3, 2, 1])
+
+
+class SingleFlightTest(TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def query():
+            calls.append(1)
+            release.wait()
+            return {'message': 'AAPL'}
+
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do(('stock', 'AAPL'), query)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        while single_flight.coalesced < 4:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'message': 'AAPL'}] * 5)
+
+    def test_errors_are_shared_and_not_remembered(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError('boom')
+
+        self.assertRaises(ValueError, single_flight.do, 'key', fail)
+        self.assertEqual(single_flight.do('key', lambda: 1), 1)
+
+
+class DayRangeBatcherTest(TestCase):
+
+    def test_requests_are_batched(self):
+        adapter = mock.Mock()
+        adapter.query_day_range.side_effect = lambda codes: {
+            'error': False, 'results': [{'error': False, 'companyCode': c} for c in codes]}
+        batcher = DayRangeBatcher(adapter, window=0.1, max_symbols=10)
+        results = {}
+
+        def query(args):
+            results[str(args)] = batcher.query_day_range(args)
+
+        threads = [threading.Thread(target=query, args=(args,))
+                   for args in ('AAPL', ['MSFT', 'aapl'], 'GOOG')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(adapter.query_day_range.call_count, 1)
+        self.assertEqual(sorted(adapter.query_day_range.call_args[0][0]), ['AAPL', 'GOOG', 'MSFT'])
+        self.assertEqual([r['companyCode'] for r in results["['MSFT', 'aapl']"]['results']], ['MSFT', 'AAPL'])
+        self.assertEqual(results['GOOG']['results'][0]['companyCode'], 'GOOG')
+
+
+class FakeWorker(object):
+    """Worker that runs until it is stopped, or dies right away with crash."""
+
+    def __init__(self, worker_id, crash=False):
+        self.worker_id = worker_id
+        self.crash = crash
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self.crash:
+            raise RuntimeError('Worker {0} crashed.'.format(self.worker_id))
+        self._stopped.wait()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class FakeProcess(object):
+    """Process that is already dead, used to check the workers without starting processes."""
+
+    pid = 0
+    exitcode = 1
+
+    def is_alive(self):
+        return False
+
+    def join(self, timeout=None):
+        pass
+
+
+class FakeConnection(object):
+    """Replaces pika's BlockingConnection, recording what is published through its channel."""
+
+    def __init__(self, fail_publish=False):
+        self.is_open = True
+        self.published = []
+        self.calls = []
+        self.fail_publish = fail_publish
+
+    def channel(self):
+        self.channel_instance = FakeConnection.Channel(self)
+        return self.channel_instance
+
+    def process_data_events(self, time_limit=None):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    class Channel(object):
+
+        def __init__(self, connection):
+            self.connection = connection
+            self.is_open = True
+
+        def queue_declare(self, queue):
+            self.connection.calls.append('queue_declare')
+
+        def tx_select(self):
+            self.connection.calls.append('tx_select')
+
+        def tx_commit(self):
+            self.connection.calls.append('tx_commit')
+
+        def basic_publish(self, exchange, routing_key, body, properties):
+            if self.connection.fail_publish:
+                raise pika.exceptions.AMQPConnectionError('Connection lost.')
+            self.connection.published.append((routing_key, body, properties.correlation_id))
+
+
+class ResponsePublisherTest(TestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.fail_publish = False
+        patcher = mock.patch('bot.publisher.pika.BlockingConnection', side_effect=self._connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _connect(self, parameters):
+        connection = FakeConnection(fail_publish=self.fail_publish)
+        self.connections.append(connection)
+        return connection
+
+    def test_connection_is_reused(self):
+        publisher = ResponsePublisher(queue='responses')
+        publisher.publish('a', 'id-1')
+        publisher.publish('b', 'id-2')
+
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].published,
+                         [('responses', 'a', 'id-1'), ('responses', 'b', 'id-2')])
+
+    def test_closed_channel_is_opened_again(self):
+        publisher = ResponsePublisher(queue='responses')
+        publisher.publish('a', 'id-1')
+        self.connections[0].channel_instance.is_open = False
+        publisher.publish('b', 'id-2')
+
+        self.assertEqual(len(self.connections), 2)
+        self.assertFalse(self.connections[0].is_open)
+        self.assertEqual(self.connections[1].published, [('responses', 'b', 'id-2')])
+
+    def test_batch_is_published_again_when_the_connection_is_lost(self):
+        publisher = ResponsePublisher(queue='responses')
+        publisher.publish('a', 'id-1')
+        self.connections[0].fail_publish = True
+        publisher.publish_batch([('b', 'id-2'), ('c', 'id-3')])
+
+        self.assertEqual(len(self.connections), 2)
+        self.assertFalse(self.connections[0].is_open)
+        self.assertEqual(self.connections[1].published,
+                         [('responses', 'b', 'id-2'), ('responses', 'c', 'id-3')])
+
+    def test_error_is_raised_when_the_second_attempt_fails(self):
+        self.fail_publish = True
+        publisher = ResponsePublisher()
+
+        self.assertRaises(pika.exceptions.AMQPConnectionError, publisher.publish, 'a', 'id-1')
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(all(not c.is_open for c in self.connections))
+
+    def test_batch_is_committed_in_a_single_transaction(self):
+        publisher = ResponsePublisher(confirm=True)
+        publisher.publish_batch([('a', 'id-1'), ('b', 'id-2')])
+        publisher.publish_batch([('c', 'id-3')])
+
+        connection = self.connections[0]
+        self.assertEqual(connection.calls, ['queue_declare', 'tx_select', 'tx_commit', 'tx_commit'])
+        self.assertEqual(len(connection.published), 3)
+
+    def test_reconnection_selects_the_transaction_again(self):
+        publisher = ResponsePublisher(confirm=True)
+        publisher.publish('a', 'id-1')
+        self.connections[0].channel_instance.is_open = False
+        publisher.publish('b', 'id-2')
+
+        self.assertEqual(self.connections[1].calls, ['queue_declare', 'tx_select', 'tx_commit'])
+
+
+class BotSupervisorTest(TestCase):
+
+    def setUp(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def _wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail('Timed out waiting for the workers.')
+            time.sleep(0.01)
+
+    def test_crashed_worker_is_restarted(self):
+        supervisor = BotSupervisor(1, lambda worker_id: FakeWorker(worker_id, crash=True))
+        supervisor.MIN_UPTIME = 0
+        supervisor._start_worker(1)
+        first = supervisor._processes[1]
+        first.join(10)
+
+        supervisor._check_workers()
+        second = supervisor._processes[1]
+        self.addCleanup(second.join, 10)
+
+        self.assertNotEqual(first.exitcode, 0)
+        self.assertIsNot(second, first)
+        self.assertNotEqual(second.pid, first.pid)
+
+    def test_sigterm_stops_all_workers(self):
+        supervisor = BotSupervisor(3, FakeWorker, shutdown_timeout=5)
+        supervisor.MONITOR_INTERVAL = 0.01
+
+        def send_sigterm():
+            self._wait_for(lambda: len(supervisor._processes) == 3 and
+                           all(p.is_alive() for p in supervisor._processes.values()))
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=send_sigterm)
+        thread.start()
+        supervisor.start()
+        thread.join()
+
+        processes = list(supervisor._processes.values())
+        self.assertEqual(len(processes), 3)
+        self.assertTrue(all(not p.is_alive() for p in processes))
+        # The workers stopped by themselves, they were not killed.
+        self.assertEqual([p.exitcode for p in processes], [0, 0, 0])
+
+    def test_restart_delay_grows_while_the_worker_keeps_crashing(self):
+        supervisor = BotSupervisor(1, FakeWorker)
+        now = [100.0]
+        delays = []
+
+        def start_worker(worker_id):
+            supervisor._processes[worker_id] = FakeProcess()
+            supervisor._started_at[worker_id] = now[0]
+            supervisor._restart_at.pop(worker_id, None)
+
+        with mock.patch('bot.supervisor.time.monotonic', lambda: now[0]), \
+                mock.patch.object(supervisor, '_start_worker', side_effect=start_worker) as start:
+            start_worker(1)
+            for _ in range(7):
+                supervisor._check_workers()
+                restarts = start.call_count
+                delay = supervisor._restart_at[1] - now[0]
+                delays.append(delay)
+                # Nothing is started until the delay passes.
+                now[0] += delay - 0.1
+                supervisor._check_workers()
+                self.assertEqual(start.call_count, restarts)
+                now[0] += 0.1
+                supervisor._check_workers()
+                self.assertEqual(start.call_count, restarts + 1)
+
+            # A worker that ran for long enough is restarted right away.
+            now[0] += supervisor.MIN_UPTIME
+            supervisor._check_workers()
+
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 30, 30])
+        self.assertEqual(start.call_count, 8)
+
+
 if __name__ == '__main__':
     unittest.main()
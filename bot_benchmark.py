@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+"""
+Script to measure the throughput of the bot without RabbitMQ or the Yahoo API. Messages are fed to a Bot
+that uses the fake quote provider, the same way the consumer loop does, and its responses are captured
+instead of being published.
+"""
+
+import argparse, json, logging, random, sys, threading, time
+
+from collections import deque
+
+from bot.cache import QuoteCache
+from bot.fake_provider import FakeChannel, FakeDelivery, FakeProperties, FakeQuoteProvider
+from bot.server import Bot
+
+DEFAULT_SYMBOLS = 'AAPL,MSFT,GOOG,AMZN,FB,APPL'
+
+
+class RecordingPublisher(object):
+    """Replaces the bot's ResponsePublisher, saving the time each response was sent."""
+
+    def __init__(self):
+        self.sent_at = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def publish(self, body, correlation_id):
+        self.publish_batch([(body, correlation_id)])
+
+    def publish_batch(self, messages):
+        now = time.perf_counter()
+        with self._lock:
+            for body, correlation_id in messages:
+                self.sent_at[correlation_id] = now
+                if json.loads(body).get('error', False):
+                    self.errors += 1
+
+    def keepalive(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the throughput of the bot using the fake '
+                                                 'quote provider.')
+    parser.add_argument('--messages', type=int, default=1000, help='Number of messages sent to the bot.')
+    parser.add_argument('--symbols', default=DEFAULT_SYMBOLS,
+                        help='Comma separated list of company codes used in the messages.')
+    parser.add_argument('--day-range-ratio', type=float, default=0.5,
+                        help='Fraction of the messages that are day_range commands.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds each fake API request takes.')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of the fake API requests that fail.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrency of the bot.')
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help='Maximum number of messages in progress. By default, twice the concurrency.')
+    parser.add_argument('--day-range-window', type=float, default=0, help='Batching window of day_range.')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the quote cache.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed used to generate the messages.')
+    return parser.parse_args(argv)
+
+
+def generate_messages(args):
+    rnd = random.Random(args.seed)
+    symbols = args.symbols.split(',')
+    messages = []
+
+    for i in range(args.messages):
+        if rnd.random() < args.day_range_ratio:
+            body = {'type': 'day_range', 'arg': rnd.sample(symbols, rnd.randint(1, min(3, len(symbols))))}
+        else:
+            body = {'type': 'stock', 'arg': rnd.choice(symbols)}
+        messages.append(('msg-{0}'.format(i), json.dumps(body).encode()))
+
+    return messages
+
+
+def run(args):
+    cache = QuoteCache(max_entries=0) if args.no_cache else QuoteCache()
+    provider = FakeQuoteProvider(cache=cache, latency=args.latency, error_rate=args.error_rate,
+                                 seed=args.seed)
+    bot = Bot(configure_message_bus=False, api_adapter=provider, concurrency=args.concurrency,
+              day_range_window=args.day_range_window)
+    publisher = RecordingPublisher()
+    bot.publisher = publisher
+    bot.channel = FakeChannel()
+
+    messages = generate_messages(args)
+    received_at = {}
+    prefetch = args.prefetch or (1 if args.concurrency == 1 else args.concurrency * 2)
+    start = time.perf_counter()
+
+    if args.concurrency == 1:
+        for correlation_id, body in messages:
+            received_at[correlation_id] = time.perf_counter()
+            bot._process_request(None, FakeDelivery(), FakeProperties(correlation_id), body)
+    else:
+        # Same work as the consumer loop of Bot.start, limiting the messages in progress to the prefetch.
+        pending = deque(enumerate(messages, start=1))
+        while len(publisher.sent_at) < len(messages):
+            while pending and len(received_at) - len(publisher.sent_at) < prefetch:
+                delivery_tag, (correlation_id, body) = pending.popleft()
+                received_at[correlation_id] = time.perf_counter()
+                bot._dispatch_request(None, FakeDelivery(delivery_tag), FakeProperties(correlation_id), body)
+            time.sleep(Bot.POLL_INTERVAL / 10)
+            bot._send_completed_responses()
+        bot._executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+    latencies = sorted(publisher.sent_at[c] - received_at[c] for c in received_at)
+    return {'elapsed': elapsed, 'latencies': latencies, 'errors': publisher.errors,
+            'upstreamRequests': provider.requests, 'coalesced': bot._single_flight.coalesced,
+            'cache': cache.stats()}
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def print_report(args, result):
+    latencies = result['latencies']
+    print('Messages:          {0}'.format(len(latencies)))
+    print('Concurrency:       {0}'.format(args.concurrency))
+    print('Elapsed:           {0:.3f} s'.format(result['elapsed']))
+    print('Throughput:        {0:.1f} messages/s'.format(len(latencies) / result['elapsed']))
+    for pct in (50, 90, 99):
+        print('Latency p{0}:       {1:.2f} ms'.format(pct, percentile(latencies, pct) * 1000))
+    print('Latency max:       {0:.2f} ms'.format(latencies[-1] * 1000))
+    print('Error responses:   {0}'.format(result['errors']))
+    print('Upstream requests: {0}'.format(result['upstreamRequests']))
+    print('Coalesced:         {0}'.format(result['coalesced']))
+    print('Cache:             {0}'.format(result['cache']))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL, stream=sys.stderr)
+    arguments = parse_args()
+    print_report(arguments, run(arguments))
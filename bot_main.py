@@ -2,17 +2,71 @@
 
 """Script to launch the bot from the command line."""
 
-import logging.config, sys
+import argparse, functools, logging.config, sys
 
+from bot.providers import PROVIDERS, create_provider
 from bot.server import Bot
+from bot.supervisor import BotSupervisor
 
 
-def start_bot():
-    bot_instance = Bot()
-    bot_instance.start()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Starts the chat bot.')
+    parser.add_argument('--provider', choices=sorted(PROVIDERS), default='yahoo',
+                        help='Service used to answer the commands. "fake" serves recorded answers.')
+    parser.add_argument('--fake-latency', type=float, default=0,
+                        help='Seconds each request to the fake provider takes.')
+    parser.add_argument('--fake-error-rate', type=float, default=0,
+                        help='Fraction of the requests to the fake provider that fail.')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='Maximum number of keep-alive connections to the Yahoo API.')
+    parser.add_argument('--connect-timeout', type=float, default=3.05,
+                        help='Seconds to wait for a connection to the Yahoo API.')
+    parser.add_argument('--read-timeout', type=float, default=10,
+                        help='Seconds to wait for the Yahoo API to send data.')
+    parser.add_argument('--max-retries', type=int, default=2,
+                        help='Number of times a failed request to the Yahoo API is retried.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Number of requests processed in parallel by the bot.')
+    parser.add_argument('--prefetch', type=int, default=None,
+                        help='Number of unacknowledged requests RabbitMQ delivers to the bot. By default, '
+                             'twice the concurrency.')
+    parser.add_argument('--publish-confirms', action='store_true',
+                        help='Wait for RabbitMQ to confirm the responses of the bot were stored.')
+    parser.add_argument('--day-range-window', type=float, default=0,
+                        help='Seconds during which day range requests are collected to query them together. '
+                             'Use with --concurrency greater than 1.')
+    parser.add_argument('--day-range-max-symbols', type=int, default=50,
+                        help='Maximum number of companies queried together in a batch of day range requests.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of bot processes. With more than one, a supervisor process starts the '
+                             'workers and restarts them if they die.')
+    return parser.parse_args(argv)
+
+
+def create_bot(args, worker_id=None):
+    options = {'pool_size': args.pool_size, 'connect_timeout': args.connect_timeout,
+               'read_timeout': args.read_timeout, 'max_retries': args.max_retries}
+    if args.provider == 'fake':
+        options.update(latency=args.fake_latency, error_rate=args.fake_error_rate)
+
+    api_adapter = create_provider(args.provider, **options)
+    return Bot(api_adapter=api_adapter, concurrency=args.concurrency, prefetch_count=args.prefetch,
+               worker_id=worker_id, publish_confirms=args.publish_confirms,
+               day_range_window=args.day_range_window, day_range_max_symbols=args.day_range_max_symbols)
+
+
+def start_bot(args):
+    if args.workers > 1:
+        supervisor = BotSupervisor(args.workers, functools.partial(create_bot, args))
+        supervisor.start()
+    else:
+        bot_instance = create_bot(args)
+        bot_instance.start()
 
 
 if __name__ == '__main__':
+    args = parse_args()
+
     logging.config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
@@ -31,4 +85,4 @@ if __name__ == '__main__':
         }
     })
 
-    start_bot()
+    start_bot(args)
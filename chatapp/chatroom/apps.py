@@ -1,9 +1,24 @@
 # encoding: utf-8
 
-import threading
+import os, sys, threading
 
 from django.apps import AppConfig
-from .receiver import BotReceiver
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from .message_buffer import recent_messages
+from .outbox import get_dispatcher, outbox_settings
+from .presence import on_user_logged_in, on_user_logged_out
+from .receiver import receiver_settings, run_bot_receiver
+from .retention import RetentionScheduler, create_retention_policy, retention_settings
+
+
+def _running_management_command():
+    """
+    Returns True if the process runs a management command other than runserver, like migrate or shell.
+    Those processes don't serve requests, so they don't need the background threads.
+    """
+    script = os.path.basename(sys.argv[0])
+    return (len(sys.argv) > 1 and script in ('manage.py', 'django-admin', 'django-admin.py')
+            and sys.argv[1] != 'runserver')
 
 
 class ChatroomConfig(AppConfig):
@@ -16,9 +31,35 @@ class ChatroomConfig(AppConfig):
     lock = threading.Lock()
 
     def ready(self):
-        # Start thread that listens for responses.
+        user_logged_in.connect(on_user_logged_in, dispatch_uid='chatroom-presence-login')
+        user_logged_out.connect(on_user_logged_out, dispatch_uid='chatroom-presence-logout')
+
         with self.lock:
-            if not self.initialized:
-                t = threading.Thread(target=BotReceiver, name='bot-receiver-thread', daemon=True)
+            if self.initialized or _running_management_command():
+                return
+
+            # Start thread that listens for responses.
+            if receiver_settings()['RUN_IN_PROCESS']:
+                t = threading.Thread(target=run_bot_receiver, name='bot-receiver-thread', daemon=True)
+                t.start()
+
+            # Start thread that sends the pending commands to the bot.
+            if outbox_settings()['RUN_IN_PROCESS']:
+                t = threading.Thread(target=get_dispatcher().run, name='outbox-dispatcher-thread',
+                                     daemon=True)
                 t.start()
-                self.initialized = True
+
+            # Start thread that removes the old data.
+            if retention_settings()['RUN_IN_PROCESS']:
+                scheduler = RetentionScheduler(create_retention_policy(),
+                                               interval=retention_settings()['INTERVAL'])
+                t = threading.Thread(target=scheduler.run, name='retention-scheduler-thread', daemon=True)
+                t.start()
+
+            # Load the last messages in memory before the first request needs them.
+            if recent_messages.size > 0:
+                t = threading.Thread(target=recent_messages.warm, name='message-buffer-warm-thread',
+                                     daemon=True)
+                t.start()
+
+            self.initialized = True
@@ -0,0 +1,43 @@
+# encoding: utf-8
+
+"""Command that removes the old commands and messages from the chat's tables."""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatroom.retention import create_retention_policy
+
+
+class Command(BaseCommand):
+    help = ('Deletes the commands already delivered to the users and moves the old messages to the archive '
+            'table. The default ages are taken from CHATROOM_RETENTION in settings.py.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report how many rows would be deleted or archived.')
+        parser.add_argument('--commands-max-age', type=int, default=None, metavar='DAYS',
+                            help='Days after which delivered commands are deleted.')
+        parser.add_argument('--messages-max-age', type=int, default=None, metavar='DAYS',
+                            help='Days after which messages are archived.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Maximum number of rows deleted or moved in a single transaction.')
+
+    def handle(self, *args, **options):
+        try:
+            policy = create_retention_policy(commands_max_age_days=options['commands_max_age'],
+                                             messages_max_age_days=options['messages_max_age'],
+                                             batch_size=options['batch_size'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        result = policy.run(dry_run=options['dry_run'])
+
+        if options['dry_run']:
+            self.stdout.write('Delivered commands older than {0} days that would be deleted: {1}'
+                              .format(policy.commands_max_age_days, result['commands']))
+            self.stdout.write('Messages older than {0} days that would be archived: {1}'
+                              .format(policy.messages_max_age_days, result['messages']))
+        else:
+            self.stdout.write('Deleted {0} delivered commands older than {1} days.'
+                              .format(result['commands'], policy.commands_max_age_days))
+            self.stdout.write('Archived {0} messages older than {1} days.'
+                              .format(result['messages'], policy.messages_max_age_days))
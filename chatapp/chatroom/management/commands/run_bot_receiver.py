@@ -0,0 +1,41 @@
+# encoding: utf-8
+
+"""Command that runs the consumers of the bot's responses outside the web processes."""
+
+import threading
+
+from django.core.management.base import BaseCommand
+
+from chatroom.receiver import run_bot_receiver
+
+
+class Command(BaseCommand):
+    help = ('Consumes the responses of the bot and saves them in the database. Set '
+            'CHATROOM_RECEIVER["RUN_IN_PROCESS"] to False to stop the web processes from consuming them too.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Number of receivers, each one with its own connection to RabbitMQ.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Maximum number of responses saved in a single transaction.')
+        parser.add_argument('--batch-timeout', type=float, default=None,
+                            help='Maximum number of seconds a response waits for its batch to be saved.')
+
+    def handle(self, *args, **options):
+        threads = []
+
+        for i in range(options['concurrency']):
+            t = threading.Thread(target=run_bot_receiver, name='bot-receiver-{0}'.format(i + 1), daemon=True,
+                                 kwargs={'batch_size': options['batch_size'],
+                                         'batch_timeout': options['batch_timeout']})
+            t.start()
+            threads.append(t)
+
+        self.stdout.write('Started {0} bot receivers. Press Ctrl+C to stop them.'.format(len(threads)))
+
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(1)
+        except KeyboardInterrupt:
+            self.stdout.write('Bot receivers stopped.')
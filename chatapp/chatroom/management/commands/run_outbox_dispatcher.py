@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+"""Command that sends the pending commands to the bot outside the web processes."""
+
+from django.core.management.base import BaseCommand
+
+from chatroom.outbox import OutboxDispatcher, outbox_settings
+
+
+class Command(BaseCommand):
+    help = ('Sends the commands saved in the outbox to the bot. Set CHATROOM_OUTBOX["RUN_IN_PROCESS"] to '
+            'False to stop the web processes from sending them too.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Maximum number of commands read from the database at once.')
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help='Seconds between checks for pending commands.')
+
+    def handle(self, *args, **options):
+        config = outbox_settings()
+        dispatcher = OutboxDispatcher(batch_size=options['batch_size'] or config['BATCH_SIZE'],
+                                      poll_interval=options['poll_interval'] or config['POLL_INTERVAL'],
+                                      claim_timeout=config['CLAIM_TIMEOUT'])
+
+        self.stdout.write('Outbox dispatcher started. Press Ctrl+C to stop it.')
+
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            dispatcher.stop()
+            self.stdout.write('Outbox dispatcher stopped.')
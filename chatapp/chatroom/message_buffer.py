@@ -0,0 +1,187 @@
+# encoding: utf-8
+
+"""In-memory buffer of the last messages posted, used to answer the most common reads of the chat."""
+
+import bisect, threading, time
+
+from collections import deque
+
+from django.conf import settings
+
+from .utils import logger
+
+DEFAULT_MESSAGE_BUFFER_SETTINGS = {
+    # Number of messages kept in memory. Zero disables the buffer.
+    'SIZE': 200,
+    # Seconds after which the buffer is loaded again from the database, to include the messages posted
+    # through other processes.
+    'MAX_AGE': 1,
+}
+
+
+def message_buffer_settings():
+    result = dict(DEFAULT_MESSAGE_BUFFER_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_MESSAGE_BUFFER', {}))
+    return result
+
+
+class RecentMessages(object):
+    """
+    Ring buffer with the last messages, already serialized, ordered by (date_posted, id). Messages posted
+    through this process are added when they are saved.
+
+    The whole buffer is loaded again from the database, with the last SIZE messages ordered by date, when it
+    is older than MAX_AGE seconds. This includes the messages posted through other processes, even the ones
+    whose transaction committed after a message with a greater id, and removes the deleted ones. Only one
+    thread loads the buffer, without holding the lock; the others keep reading the previous contents
+    meanwhile, so reads never wait for the database and make at most one query per MAX_AGE seconds.
+    """
+
+    def __init__(self, size=200, max_age=1, clock=time.monotonic):
+        self.size = size
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._messages = deque(maxlen=size)
+        self._keys = deque(maxlen=size)
+        # Time the buffer was loaded, or None if it is not loaded.
+        self._loaded_at = None
+        self._loading = False
+        # Messages added while the buffer is being loaded. They are added again to the loaded messages.
+        self._added_while_loading = []
+        # Date of the newest message known to be missing from the buffer. Every message posted after it is
+        # in the buffer. None while the buffer holds every message of the database.
+        self._floor = None
+
+    def warm(self):
+        """Loads the last messages from the database."""
+        try:
+            self._refresh()
+        except Exception as e:
+            # They are loaded again by the first request.
+            logger.error('Error loading the last messages in memory.')
+            logger.exception(e)
+
+    def add(self, message):
+        """Adds a message that was just saved."""
+        with self._lock:
+            if self._loading:
+                self._added_while_loading.append(message)
+            # Nothing else to do if the buffer was not loaded yet. The messages are loaded on the next read.
+            if self._loaded_at is not None:
+                self._add(message)
+
+    def last(self, count):
+        """Returns the last count messages, or None if the buffer doesn't have all of them."""
+        if not self._refresh_if_stale():
+            return None
+
+        with self._lock:
+            if count > len(self._messages) and self._floor is not None:
+                return None
+            return list(self._messages)[-count:] if count > 0 else []
+
+    def since(self, date_posted, limit):
+        """
+        Returns the last messages, up to limit, posted after date_posted, or None if some of them could be
+        missing from the buffer.
+        """
+        if not self._refresh_if_stale():
+            return None
+
+        with self._lock:
+            # Index of the first message posted after date_posted.
+            start = bisect.bisect_right([key[0] for key in self._keys], date_posted)
+            if self._floor is not None and date_posted < self._floor and len(self._messages) - start < limit:
+                return None
+            return list(self._messages)[max(start, len(self._messages) - limit):]
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._loaded_at = None
+
+    def _refresh_if_stale(self):
+        """
+        Loads the buffer again if it is older than max_age, unless another thread is already doing it.
+        Returns True if the buffer can be read.
+        """
+        if self.size <= 0:
+            return False
+
+        with self._lock:
+            loaded_at = self._loaded_at
+            if self._loading or (loaded_at is not None and self._clock() - loaded_at < self.max_age):
+                return loaded_at is not None
+
+        return self._refresh()
+
+    def _refresh(self):
+        """Loads the last messages from the database. Returns True if the buffer was loaded."""
+        from .models import Message
+
+        with self._lock:
+            if self._loading:
+                return self._loaded_at is not None
+            self._loading = True
+            self._added_while_loading = []
+
+        try:
+            loaded_at = self._clock()
+            messages = list(Message.objects.select_related('user').order_by('-date_posted', '-id')
+                            [:self.size])
+        except Exception:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self._reset()
+            for message in reversed(messages):
+                self._add(message)
+            if len(messages) == self.size:
+                self._floor = messages[-1].date_posted
+            for message in self._added_while_loading:
+                self._add(message)
+            self._added_while_loading = []
+            self._loaded_at = loaded_at
+            self._loading = False
+
+        return True
+
+    def _add(self, message):
+        key = (message.date_posted, message.id)
+        position = bisect.bisect_right(self._keys, key)
+
+        if position > 0 and self._keys[position - 1] == key:
+            return
+
+        if len(self._keys) == self.size:
+            # The oldest message is dropped.
+            dropped = key if position == 0 else self._keys[0]
+            self._floor = dropped[0] if self._floor is None else max(self._floor, dropped[0])
+            if position == 0:
+                return
+
+        if position == len(self._keys):
+            self._keys.append(key)
+            self._messages.append(message.to_json_safe_object())
+        else:
+            # Messages are almost always added in order. Dates taken by different threads or processes
+            # can arrive a little out of order.
+            if len(self._keys) == self.size:
+                self._keys.popleft()
+                self._messages.popleft()
+                position -= 1
+            self._keys.insert(position, key)
+            self._messages.insert(position, message.to_json_safe_object())
+
+    def _reset(self):
+        self._messages.clear()
+        self._keys.clear()
+        self._floor = None
+
+
+# Buffer shared by all the threads of the process.
+recent_messages = RecentMessages(size=message_buffer_settings()['SIZE'],
+                                 max_age=message_buffer_settings()['MAX_AGE'])
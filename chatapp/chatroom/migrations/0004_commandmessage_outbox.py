@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:34
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0003_auto_20170405_1657'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandmessage',
+            name='date_dispatched',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='date the command was sent to the bot'),
+        ),
+        migrations.AddField(
+            model_name='commandmessage',
+            name='dispatch_attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='number of failed attempts to send the command.'),
+        ),
+        # Commands saved before the outbox existed were already published to RabbitMQ.
+        migrations.AddField(
+            model_name='commandmessage',
+            name='dispatch_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent')], db_index=True, default='sent', max_length=10, verbose_name='indicates whether the command was sent to the bot.'),
+        ),
+        migrations.AlterField(
+            model_name='commandmessage',
+            name='dispatch_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent')], db_index=True, default='pending', max_length=10, verbose_name='indicates whether the command was sent to the bot.'),
+        ),
+    ]
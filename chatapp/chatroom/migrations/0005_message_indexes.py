@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:39
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatroom', '0004_commandmessage_outbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date_posted',
+            field=models.DateTimeField(db_index=True, verbose_name='Posted date'),
+        ),
+        migrations.AlterIndexTogether(
+            name='commandmessage',
+            index_together=set([('user', 'read', 'date_answered')]),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0005_message_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='date_posted',
+            field=models.DateTimeField(verbose_name='Posted date'),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('date_posted', 'id')]),
+        ),
+    ]
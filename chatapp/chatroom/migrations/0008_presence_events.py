@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:45
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatroom', '0007_presence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PresenceEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined', models.BooleanField(verbose_name='true if the user joined the chat, false if the user left.')),
+                ('date_created', models.DateTimeField(db_index=True, verbose_name='date of the event')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='user')),
+            ],
+            options={
+                'verbose_name': 'presence event',
+                'verbose_name_plural': 'presence events',
+            },
+        ),
+        migrations.AddField(
+            model_name='presence',
+            name='online',
+            field=models.BooleanField(default=True, verbose_name='indicates whether the user is shown as online.'),
+        ),
+        migrations.AlterIndexTogether(
+            name='presence',
+            index_together=set([('online', 'last_seen')]),
+        ),
+    ]
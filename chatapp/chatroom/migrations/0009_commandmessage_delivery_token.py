@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0008_presence_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandmessage',
+            name='delivery_token',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True, verbose_name='identifier of the request that sent the answer to the user.'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0009_commandmessage_delivery_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandmessage',
+            name='rendered',
+            field=models.TextField(blank=True, null=True, verbose_name='the chat messages of the answer'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:49
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chatroom', '0010_commandmessage_rendered'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False, verbose_name='id of the message in the messages table')),
+                ('date_posted', models.DateTimeField(db_index=True, verbose_name='Posted date')),
+                ('text', models.TextField(verbose_name='Message text')),
+                ('date_archived', models.DateTimeField(verbose_name='date the message was archived')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='User who posted the message.')),
+            ],
+            options={
+                'verbose_name': 'archived message',
+                'verbose_name_plural': 'archived messages',
+            },
+        ),
+        migrations.AlterField(
+            model_name='commandmessage',
+            name='date_posted',
+            field=models.DateTimeField(db_index=True, verbose_name='posted date'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:58
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0011_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandmessage',
+            name='date_claimed',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='date the command was claimed by a dispatcher'),
+        ),
+        migrations.AddField(
+            model_name='commandmessage',
+            name='dispatch_token',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True, verbose_name='identifier of the dispatcher run that sends the command.'),
+        ),
+        migrations.AlterField(
+            model_name='commandmessage',
+            name='dispatch_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('in_flight', 'Being sent'), ('sent', 'Sent')], db_index=True, default='pending', max_length=10, verbose_name='indicates whether the command was sent to the bot.'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-16 22:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatroom', '0012_commandmessage_dispatch_claim'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='commandmessage',
+            name='date_answered',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='response date'),
+        ),
+    ]
@@ -24,11 +24,14 @@ class Message(models.Model):
         """
         Returns data of this object as a json-safe dictionary
         """
-        return {'text': self.text, 'user': {'id': self.user_id, 'username': self.user.username},
+        return {'id': self.id, 'text': self.text,
+                'user': {'id': self.user_id, 'username': self.user.username},
                 'timestamp': datetime_aware_to_str(self.date_posted), 'type': 'message'}
 
     class Meta:
         ordering = ['-date_posted']
+        # Pages of the history are read in this order. It also serves the searches by date.
+        index_together = [('date_posted', 'id')]
         verbose_name = 'mensaje'
         verbose_name_plural = 'mensajes'
 
@@ -36,22 +39,105 @@ class Message(models.Model):
 class CommandMessage(models.Model):
     """
     Saves the data of a command and its answer. It serves as a temporary storage for command results
-    until they are requested by the user.
+    until they are requested by the user. It is also the outbox of the commands: they are saved as pending,
+    and sent to the bot later by the OutboxDispatcher.
     """
+    DISPATCH_PENDING = 'pending'
+    DISPATCH_IN_FLIGHT = 'in_flight'
+    DISPATCH_SENT = 'sent'
+    DISPATCH_STATUS_CHOICES = ((DISPATCH_PENDING, 'Pending'), (DISPATCH_IN_FLIGHT, 'Being sent'),
+                               (DISPATCH_SENT, 'Sent'))
+
     # This field holds the correlation_id of the message to match it against the received response.
     uuid = models.UUIDField('message identifier', primary_key=True, default=uuid.uuid4, editable=False)
-    date_posted = models.DateTimeField('posted date')
-    date_answered = models.DateTimeField('response date', null=True, blank=True)
+    date_posted = models.DateTimeField('posted date', db_index=True)
+    date_answered = models.DateTimeField('response date', null=True, blank=True, db_index=True)
     request = models.TextField('the contents of the message sent')
     response = models.TextField('the contents of the message received', null=True, blank=True)
+    # JSON array with the chat messages of the answer, built when it is received. See chatroom.replies.
+    rendered = models.TextField('the chat messages of the answer', null=True, blank=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='+',
                              verbose_name='user who sent the command.')
     read = models.BooleanField('indicates whether the message was sent to the user.', default=False)
+    # Random value set when the answer is claimed by a request, to read back exactly the claimed answers.
+    delivery_token = models.UUIDField('identifier of the request that sent the answer to the user.',
+                                      null=True, blank=True, editable=False, db_index=True)
+    dispatch_status = models.CharField('indicates whether the command was sent to the bot.', max_length=10,
+                                       choices=DISPATCH_STATUS_CHOICES, default=DISPATCH_PENDING,
+                                       db_index=True)
+    dispatch_attempts = models.PositiveIntegerField('number of failed attempts to send the command.',
+                                                    default=0)
+    # Random value set when a dispatcher claims the command, to read back exactly the claimed commands.
+    dispatch_token = models.UUIDField('identifier of the dispatcher run that sends the command.', null=True,
+                                      blank=True, editable=False, db_index=True)
+    date_claimed = models.DateTimeField('date the command was claimed by a dispatcher', null=True, blank=True)
+    date_dispatched = models.DateTimeField('date the command was sent to the bot', null=True, blank=True)
 
     def __str__(self):
         return 'Command {0} from {1}'.format(self.uuid, self.user.username)
 
     class Meta:
         ordering = ['-date_posted']
+        # Used to find the unread answers of a user.
+        index_together = [('user', 'read', 'date_answered')]
         verbose_name = 'command message'
         verbose_name_plural = 'command messages'
+
+
+class Presence(models.Model):
+    """
+    Saves the last time a user made a request to the chat, and whether the user is shown as online. See
+    chatroom.presence.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name='+', verbose_name='user')
+    last_seen = models.DateTimeField('date of the last request of the user', db_index=True)
+    online = models.BooleanField('indicates whether the user is shown as online.', default=True)
+
+    def __str__(self):
+        return 'User {0} seen at {1:%Y-%m-%d %H:%M:%S}'.format(self.user_id, self.last_seen)
+
+    class Meta:
+        # Used to find the online users whose last request is too old.
+        index_together = [('online', 'last_seen')]
+        verbose_name = 'presence'
+        verbose_name_plural = 'presences'
+
+
+class PresenceEvent(models.Model):
+    """
+    A user that joined or left the chat. The id of the last event is the version of the list of online
+    users, and browsers ask for the events after the version they have.
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+',
+                             verbose_name='user')
+    joined = models.BooleanField('true if the user joined the chat, false if the user left.')
+    date_created = models.DateTimeField('date of the event', db_index=True)
+
+    def __str__(self):
+        action = 'joined' if self.joined else 'left'
+        return 'User {0} {1} at {2:%Y-%m-%d %H:%M:%S}'.format(self.user_id, action, self.date_created)
+
+    class Meta:
+        verbose_name = 'presence event'
+        verbose_name_plural = 'presence events'
+
+
+class ArchivedMessage(models.Model):
+    """
+    A message moved out of the Message table because it is old. It keeps the id it had in that table.
+    See chatroom.retention.
+    """
+    id = models.IntegerField('id of the message in the messages table', primary_key=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='+',
+                             verbose_name='User who posted the message.')
+    date_posted = models.DateTimeField('Posted date', db_index=True)
+    text = models.TextField('Message text')
+    date_archived = models.DateTimeField('date the message was archived')
+
+    def __str__(self):
+        return 'Archived message from {0} at {1:%Y-%m-%d %H:%M:%S}'.format(self.user_id, self.date_posted)
+
+    class Meta:
+        verbose_name = 'archived message'
+        verbose_name_plural = 'archived messages'
@@ -0,0 +1,175 @@
+# encoding: utf-8
+
+"""In-process notifications used to wake up the requests that wait for new messages."""
+
+import threading, time
+
+from django.conf import settings
+from django.db.models import Max
+
+DEFAULT_LONG_POLL_SETTINGS = {
+    # Maximum number of seconds a request for updates can wait for new messages.
+    'MAX_WAIT': 25,
+    # Seconds between checks of the database for changes made by other processes, like messages posted to
+    # another server process or answers saved by "manage.py run_bot_receiver". Zero disables the checks.
+    'CHECK_INTERVAL': 1,
+}
+
+
+def long_poll_settings():
+    result = dict(DEFAULT_LONG_POLL_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_LONG_POLL', {}))
+    return result
+
+
+DEFAULT_STREAM_SETTINGS = {
+    # Seconds without events after which a heartbeat is sent, so proxies don't close the connection.
+    'HEARTBEAT': 15,
+    # Seconds after which the stream is closed. The browser reconnects by itself.
+    'MAX_DURATION': 300,
+    # Milliseconds the browser waits before reconnecting.
+    'RETRY': 3000,
+}
+
+
+def stream_settings():
+    result = dict(DEFAULT_STREAM_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_STREAM', {}))
+    return result
+
+
+class NotificationHub(object):
+    """
+    Keeps a version number for the chat messages, one for the list of online users, and one for the bot
+    responses of each user. Versions are incremented when something new is saved, waking up the threads
+    waiting for a change.
+
+    Notifications only reach the requests served by the same process. For the changes made by other
+    processes, the waiting threads check the state of the database every check_interval seconds. The check
+    is shared by all the threads of the process, and makes the same wake-ups as the notifications: when
+    there are new answers of the bot, only the users whose commands were answered are woken up.
+    """
+
+    def __init__(self, check_interval=0, database_state=None, answered_users=None):
+        """
+        :param check_interval: Seconds between checks of the database. Zero disables them.
+        :param database_state: Function that returns a tuple with the state of the messages, the list of
+            online users and the date of the last answer of the bot, in that order. By default,
+            get_database_state.
+        :param answered_users: Function that receives the date of an answer of the bot, or None, and
+            returns the ids of the users with answers after it. By default, get_answered_users.
+        """
+        self.check_interval = check_interval
+        self._database_state = database_state or get_database_state
+        self._answered_users = answered_users or get_answered_users
+        self._condition = threading.Condition()
+        self._message_version = 0
+        self._presence_version = 0
+        self._user_versions = {}
+        self._check_lock = threading.Lock()
+        self._last_check = None
+        self._last_state = None
+
+    def version(self, user_id):
+        """Returns the current version of the updates for a user. Used to wait for changes after it."""
+        with self._condition:
+            return self._version(user_id)
+
+    def notify_message(self):
+        """Wakes up all the waiters, because a new message was posted."""
+        with self._condition:
+            self._message_version += 1
+            self._condition.notify_all()
+
+    def notify_presence(self):
+        """Wakes up all the waiters, because a user joined or left the chat."""
+        with self._condition:
+            self._presence_version += 1
+            self._condition.notify_all()
+
+    def notify_user(self, user_ids):
+        """Wakes up the waiters of the given users, because they have new bot responses."""
+        with self._condition:
+            for user_id in user_ids:
+                self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, user_id, version, timeout):
+        """
+        Waits until the version of the user's updates is different from the given one, or until timeout
+        seconds passed. Returns True if there was a change.
+        """
+        if self.check_interval <= 0:
+            with self._condition:
+                return self._condition.wait_for(lambda: self._version(user_id) != version, timeout)
+
+        deadline = time.monotonic() + timeout
+
+        while True:
+            self.check_database()
+            remaining = deadline - time.monotonic()
+
+            with self._condition:
+                if self._condition.wait_for(lambda: self._version(user_id) != version,
+                                            max(0, min(remaining, self.check_interval))):
+                    return True
+
+            if remaining <= self.check_interval:
+                return False
+
+    def check_database(self):
+        """
+        Compares the state of the database with the one of the last check, and wakes up the waiters if it
+        changed. Does nothing if the last check is more recent than check_interval seconds.
+        """
+        with self._check_lock:
+            now = time.monotonic()
+            if self._last_check is not None and now - self._last_check < self.check_interval:
+                return
+            self._last_check = now
+            previous, state = self._last_state, self._database_state()
+            self._last_state = state
+
+            if previous is None or state == previous:
+                return
+
+            # Only the users with answers after the previous check are woken up.
+            user_ids = self._answered_users(previous[2]) if state[2] != previous[2] else []
+
+        with self._condition:
+            if state[0] != previous[0]:
+                self._message_version += 1
+            if state[1] != previous[1]:
+                self._presence_version += 1
+            for user_id in user_ids:
+                self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._condition.notify_all()
+
+    def _version(self, user_id):
+        return self._message_version, self._presence_version, self._user_versions.get(user_id, 0)
+
+
+def get_database_state():
+    """
+    Returns the id of the last message, the id of the last presence event and the date of the last answer
+    of the bot. Each one is read from an index.
+    """
+    from .models import CommandMessage, Message, PresenceEvent
+
+    return (Message.objects.aggregate(last=Max('id'))['last'],
+            PresenceEvent.objects.aggregate(last=Max('id'))['last'],
+            CommandMessage.objects.aggregate(last=Max('date_answered'))['last'])
+
+
+def get_answered_users(date_answered):
+    """Returns the ids of the users with answers of the bot after the given date, or all of them if None."""
+    from .models import CommandMessage
+
+    commands = CommandMessage.objects.filter(date_answered__isnull=False)
+    if date_answered is not None:
+        commands = commands.filter(date_answered__gt=date_answered)
+    return set(commands.order_by().values_list('user_id', flat=True).distinct())
+
+
+# Hub shared by all the threads of the process.
+hub = NotificationHub(check_interval=long_poll_settings()['CHECK_INTERVAL'])
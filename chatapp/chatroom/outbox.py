@@ -0,0 +1,177 @@
+# encoding: utf-8
+
+"""Dispatcher of the commands saved in the outbox (the CommandMessage table) to the bot."""
+
+import threading, uuid
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .publisher import BrokerUnavailableError, get_publisher
+from .utils import logger
+
+DEFAULT_OUTBOX_SETTINGS = {
+    # Start the dispatcher in a thread of the Django process.
+    'RUN_IN_PROCESS': True,
+    # Maximum number of commands read from the database at once.
+    'BATCH_SIZE': 100,
+    # Seconds between checks for pending commands, when the dispatcher is not woken up by a new command.
+    'POLL_INTERVAL': 2,
+    # Seconds after which a command claimed by a dispatcher and not marked as sent is claimed again, in case
+    # the process of that dispatcher died.
+    'CLAIM_TIMEOUT': 60,
+}
+
+
+def outbox_settings():
+    result = dict(DEFAULT_OUTBOX_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_OUTBOX', {}))
+    return result
+
+
+class OutboxDispatcher(object):
+    """
+    Publishes the pending commands to RabbitMQ, in batches and in the order they were posted, and marks
+    them as sent. The message's UUID is used as correlation id. Commands that can't be published stay
+    pending and are tried again later, even after a restart of the process.
+
+    Every web process can run a dispatcher. A batch is claimed with a conditional update before it is
+    published, so each command is sent by a single dispatcher.
+
+    Delivery is at least once: if the process dies after claiming a batch but before marking it as sent,
+    those commands are claimed again after CLAIM_TIMEOUT seconds and published again. Answers of the bot are
+    matched by UUID, so a repeated answer simply overwrites the first one.
+    """
+
+    def __init__(self, batch_size=100, poll_interval=2, claim_timeout=60, publisher=None):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self._publisher = publisher
+        self._wakeup = threading.Event()
+        self._running = False
+
+    @property
+    def publisher(self):
+        return self._publisher if self._publisher is not None else get_publisher()
+
+    def wake(self):
+        """Makes the dispatcher look for pending commands immediately."""
+        self._wakeup.set()
+
+    def dispatch_pending(self):
+        """Publishes a batch of pending commands. Returns the number of commands sent."""
+        from .models import CommandMessage
+
+        token, claimed = self._claim_batch()
+        sent = []
+
+        for command_uuid, request in claimed:
+            try:
+                logger.debug('Sending message (corr_id=%s) to queue bot_requests: %s', command_uuid, request)
+                self.publisher.publish(str(command_uuid), request)
+                sent.append(command_uuid)
+            except BrokerUnavailableError as e:
+                logger.error('Command %s could not be sent to the bot: %s', command_uuid, e)
+                (CommandMessage.objects.filter(uuid=command_uuid)
+                 .update(dispatch_attempts=F('dispatch_attempts') + 1))
+                # The rest of the batch would fail too. They are retried in the next iteration.
+                break
+
+        if sent:
+            (CommandMessage.objects.filter(uuid__in=sent, dispatch_token=token)
+             .update(dispatch_status=CommandMessage.DISPATCH_SENT, date_dispatched=timezone.now()))
+
+        if len(sent) < len(claimed):
+            # The commands that were not sent can be claimed again immediately.
+            unsent = CommandMessage.objects.filter(dispatch_token=token,
+                                                   dispatch_status=CommandMessage.DISPATCH_IN_FLIGHT)
+            unsent.update(dispatch_status=CommandMessage.DISPATCH_PENDING, dispatch_token=None,
+                          date_claimed=None)
+
+        return len(sent)
+
+    def _claim_batch(self):
+        """
+        Marks a batch of pending commands as in flight, with a new token. Commands claimed at the same time
+        by another dispatcher are left out by the conditions of the update. Returns the token and the list
+        of (uuid, request) of the claimed commands.
+        """
+        from .models import CommandMessage
+
+        now = timezone.now()
+        claimable = (Q(dispatch_status=CommandMessage.DISPATCH_PENDING)
+                     | Q(dispatch_status=CommandMessage.DISPATCH_IN_FLIGHT,
+                         date_claimed__lt=now - timezone.timedelta(seconds=self.claim_timeout)))
+        candidates = list(CommandMessage.objects.filter(claimable).order_by('date_posted')
+                          .values_list('uuid', flat=True)[:self.batch_size])
+
+        if not candidates:
+            return None, []
+
+        token = uuid.uuid4()
+        (CommandMessage.objects.filter(claimable, uuid__in=candidates)
+         .update(dispatch_status=CommandMessage.DISPATCH_IN_FLIGHT, dispatch_token=token, date_claimed=now))
+        return token, list(CommandMessage.objects.filter(dispatch_token=token).order_by('date_posted')
+                           .values_list('uuid', 'request'))
+
+    def run(self):
+        self._running = True
+        logger.info('Outbox dispatcher started.')
+
+        while self._running:
+            sent = 0
+            # Cleared before reading, so a command saved while a batch is sent is not missed.
+            self._wakeup.clear()
+
+            try:
+                close_old_connections()
+                sent = self.dispatch_pending()
+            except Exception as e:
+                logger.error('Error dispatching pending commands.')
+                logger.exception(e)
+
+            # A full batch means there can be more pending commands.
+            if sent < self.batch_size:
+                if not sent:
+                    self._keepalive()
+                self._wakeup.wait(self.poll_interval)
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def _keepalive(self):
+        """
+        Keeps the idle connection of the publisher open. The poll interval is much shorter than the
+        heartbeat timeout of RabbitMQ.
+        """
+        try:
+            self.publisher.keepalive()
+        except Exception as e:
+            logger.error('Error processing the events of the connection to RabbitMQ.')
+            logger.exception(e)
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Returns the OutboxDispatcher of the process."""
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            config = outbox_settings()
+            _dispatcher = OutboxDispatcher(batch_size=config['BATCH_SIZE'],
+                                           poll_interval=config['POLL_INTERVAL'],
+                                           claim_timeout=config['CLAIM_TIMEOUT'])
+        return _dispatcher
+
+
+def notify_new_command():
+    """Wakes up the dispatcher of the process, so a newly saved command is sent without waiting."""
+    get_dispatcher().wake()
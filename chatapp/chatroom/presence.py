@@ -0,0 +1,191 @@
+# encoding: utf-8
+
+"""Tracks which users are online, from the requests they make to the chat."""
+
+import threading, time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .notifications import hub
+
+DEFAULT_PRESENCE_SETTINGS = {
+    # Seconds since the last request after which a user is not online anymore.
+    'TIMEOUT': 30,
+    # Minimum number of seconds between updates of the last request date of a user.
+    'HEARTBEAT_INTERVAL': 10,
+    # Seconds the join and leave events are kept. Browsers with an older version get the full list.
+    'EVENTS_RETENTION': 3600,
+    # Maximum number of events sent as changes. The full list is sent instead if there are more.
+    'MAX_CHANGES': 100,
+}
+
+
+def presence_settings():
+    result = dict(DEFAULT_PRESENCE_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_PRESENCE', {}))
+    return result
+
+
+class PresenceTracker(object):
+    """
+    Saves the date of the last request of every user in the Presence table, indexed by date, so the users
+    online are found with a range query that reads only their rows. To avoid a write on every request, the
+    date is only updated if it is older than HEARTBEAT_INTERVAL seconds. The browser asks for the online
+    users every few seconds, which keeps the users that have the chat open online.
+
+    Every time a user joins or leaves, a PresenceEvent is saved. The id of the last event is the version of
+    the list of online users, so browsers can ask only for the changes after the version they have. Users
+    whose last request is older than TIMEOUT are marked as offline, with their leave events, when the list
+    or the changes are read.
+    """
+
+    def __init__(self, timeout=30, heartbeat_interval=10, events_retention=3600, max_changes=100):
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.events_retention = events_retention
+        self.max_changes = max_changes
+        self._lock = threading.Lock()
+        # Time of the last update made by this process, by user id.
+        self._last_updates = {}
+
+    def heartbeat(self, user):
+        """Records that the user made a request."""
+        now = time.monotonic()
+
+        with self._lock:
+            if now - self._last_updates.get(user.id, -self.heartbeat_interval) < self.heartbeat_interval:
+                return
+            self._last_updates[user.id] = now
+
+        self._save(user.id, timezone.now())
+
+    def leave(self, user):
+        """Removes the user from the online users, for example when the user logs out."""
+        from .models import Presence, PresenceEvent
+
+        with self._lock:
+            self._last_updates.pop(user.id, None)
+
+        with transaction.atomic():
+            if Presence.objects.filter(user_id=user.id, online=True).update(online=False):
+                PresenceEvent.objects.create(user_id=user.id, joined=False, date_created=timezone.now())
+                transaction.on_commit(hub.notify_presence)
+
+    def version(self):
+        """Returns the version of the list of online users."""
+        self._expire()
+        return self._version()
+
+    def online_user_ids(self, expire=True):
+        """
+        Returns the ids of the users online. With expire=False, users are not marked as offline first, for
+        callers that just called version().
+        """
+        if expire:
+            self._expire()
+        return self._online_user_ids()
+
+    def changes(self, since_version):
+        """
+        Returns a dict with the new version, and the ids of the users that joined and left after
+        since_version. If since_version is None or too old, "full" is True and "joined" has all the users
+        online.
+        """
+        from .models import PresenceEvent
+
+        self._expire()
+        version = self._version()
+        first_event = PresenceEvent.objects.aggregate(first=Min('id'))['first']
+
+        # The events after since_version must still be kept, and not be too many.
+        if since_version is not None and since_version <= version and \
+                (first_event is None or since_version >= first_event - 1):
+            events = list(PresenceEvent.objects.filter(id__gt=since_version).order_by('id')
+                          .values_list('id', 'user_id', 'joined')[:self.max_changes + 1])
+
+            if len(events) <= self.max_changes:
+                # Only the last event of every user matters.
+                states = dict((user_id, joined) for _, user_id, joined in events)
+                return {'version': max([version] + [event_id for event_id, _, _ in events]), 'full': False,
+                        'joined': sorted(uid for uid, joined in states.items() if joined),
+                        'left': sorted(uid for uid, joined in states.items() if not joined)}
+
+        # Events saved after the version was read are sent again in the next changes. Repeated joins and
+        # leaves don't change the list of the browser.
+        return {'version': version, 'full': True, 'joined': self._online_user_ids(), 'left': []}
+
+    def clear(self):
+        with self._lock:
+            self._last_updates.clear()
+
+    def _save(self, user_id, last_seen):
+        from .models import Presence, PresenceEvent
+
+        since = last_seen - timezone.timedelta(seconds=self.timeout)
+        if Presence.objects.filter(user_id=user_id, online=True, last_seen__gte=since).update(
+                last_seen=last_seen):
+            return
+
+        # The user was offline, or was not seen before.
+        with transaction.atomic():
+            if not Presence.objects.filter(user_id=user_id).update(last_seen=last_seen, online=True):
+                try:
+                    with transaction.atomic():
+                        Presence.objects.create(user_id=user_id, last_seen=last_seen, online=True)
+                except IntegrityError:
+                    # Created by another request at the same time.
+                    Presence.objects.filter(user_id=user_id).update(last_seen=last_seen, online=True)
+            PresenceEvent.objects.create(user_id=user_id, joined=True, date_created=last_seen)
+            transaction.on_commit(hub.notify_presence)
+
+    def _version(self):
+        from .models import PresenceEvent
+        return PresenceEvent.objects.aggregate(version=Max('id'))['version'] or 0
+
+    def _online_user_ids(self):
+        from .models import Presence
+        return list(Presence.objects.filter(online=True).order_by('user_id')
+                    .values_list('user_id', flat=True))
+
+    def _expire(self):
+        """Marks the users not seen in TIMEOUT seconds as offline, and deletes the old events."""
+        from .models import Presence, PresenceEvent
+
+        now = timezone.now()
+        since = now - timezone.timedelta(seconds=self.timeout)
+        expired = list(Presence.objects.filter(online=True, last_seen__lt=since)
+                       .values_list('user_id', flat=True))
+
+        if expired:
+            with transaction.atomic():
+                # Users are updated one by one, and a leave event is saved only for the ones this call marked
+                # as offline. Users marked by another request, or seen again after they were read, are
+                # skipped.
+                left = [user_id for user_id in expired if Presence.objects.filter(
+                    user_id=user_id, online=True, last_seen__lt=since).update(online=False)]
+                PresenceEvent.objects.bulk_create([PresenceEvent(user_id=user_id, joined=False,
+                                                                 date_created=now) for user_id in left])
+                if left:
+                    transaction.on_commit(hub.notify_presence)
+
+            PresenceEvent.objects.filter(
+                date_created__lt=now - timezone.timedelta(seconds=self.events_retention)).delete()
+
+
+# Tracker shared by all the threads of the process.
+presence_tracker = PresenceTracker(timeout=presence_settings()['TIMEOUT'],
+                                   heartbeat_interval=presence_settings()['HEARTBEAT_INTERVAL'],
+                                   events_retention=presence_settings()['EVENTS_RETENTION'],
+                                   max_changes=presence_settings()['MAX_CHANGES'])
+
+
+def on_user_logged_in(sender, request, user, **kwargs):
+    presence_tracker.heartbeat(user)
+
+
+def on_user_logged_out(sender, request, user, **kwargs):
+    if user is not None:
+        presence_tracker.leave(user)
@@ -0,0 +1,140 @@
+# encoding: utf-8
+
+"""Publisher of the commands sent to the bot through RabbitMQ."""
+
+import os, pika, threading, time
+
+from django.conf import settings
+
+from .utils import logger
+
+DEFAULT_BROKER_SETTINGS = {
+    'HOST': 'localhost',
+    'REQUESTS_QUEUE': 'bot_requests',
+    'RESPONSES_QUEUE': 'bot_responses',
+    # Seconds to wait for the connection to RabbitMQ before giving up.
+    'CONNECT_TIMEOUT': 2,
+    # Seconds during which new connections are not attempted after RabbitMQ was found unavailable.
+    'RETRY_INTERVAL': 5,
+}
+
+
+def broker_settings():
+    """Returns the settings of the connection to RabbitMQ, taken from CHATROOM_BROKER in settings.py."""
+    result = dict(DEFAULT_BROKER_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_BROKER', {}))
+    return result
+
+
+class BrokerUnavailableError(Exception):
+    """Raised when a command cannot be published because RabbitMQ is not available."""
+    pass
+
+
+class CommandPublisher(object):
+    """
+    Keeps a connection to RabbitMQ open for the life of the process, shared by all the threads that publish
+    commands. If the connection is lost, it is opened again on the next publish. When RabbitMQ cannot be
+    reached, publishing fails fast during RETRY_INTERVAL seconds instead of making every request wait for
+    the connection timeout.
+    """
+
+    def __init__(self, host='localhost', queue='bot_requests', connect_timeout=2, retry_interval=5):
+        self.host = host
+        self.queue = queue
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._connection = None
+        self._channel = None
+        self._unavailable_until = 0
+
+    def publish(self, correlation_id, body):
+        """Publishes a command for the bot. Raises BrokerUnavailableError if it could not be sent."""
+        with self._lock:
+            for attempt in (1, 2):
+                channel = self._get_channel()
+                try:
+                    channel.basic_publish(exchange='', routing_key=self.queue, body=body,
+                                          properties=pika.BasicProperties(correlation_id=correlation_id))
+                    return
+                except pika.exceptions.AMQPError as e:
+                    # The connection was probably closed by the broker. Try once more with a new one.
+                    logger.warning('Error publishing command (corr_id=%s): %s', correlation_id,
+                                   e.__class__.__name__)
+                    self._close()
+
+            raise BrokerUnavailableError('Could not publish the command to RabbitMQ.')
+
+    def keepalive(self):
+        """
+        Processes the events of the open connection, including its heartbeats. It must be called
+        periodically while no commands are published, or RabbitMQ closes the idle connection. A connection
+        is not opened if there is none.
+        """
+        with self._lock:
+            if self._connection is None or not self._connection.is_open:
+                return
+
+            try:
+                self._connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError as e:
+                logger.warning('Connection to RabbitMQ lost: %s', e.__class__.__name__)
+                self._close()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _get_channel(self):
+        """Returns the channel, connecting if needed. The lock must be held by the caller."""
+        if self._channel is not None and self._channel.is_open and self._connection.is_open:
+            return self._channel
+
+        self._close()
+
+        if time.monotonic() < self._unavailable_until:
+            raise BrokerUnavailableError('RabbitMQ is not available.')
+
+        try:
+            self._connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=self.host, connection_attempts=1,
+                                          socket_timeout=self.connect_timeout))
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self.queue)
+        except (pika.exceptions.AMQPError, OSError) as e:
+            logger.error('Cannot connect to RabbitMQ at %s: %s', self.host, e.__class__.__name__)
+            self._close()
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            raise BrokerUnavailableError('RabbitMQ is not available.') from e
+
+        return self._channel
+
+    def _close(self):
+        connection, self._connection, self._channel = self._connection, None, None
+
+        if connection is not None and connection.is_open:
+            try:
+                connection.close()
+            except (pika.exceptions.AMQPError, OSError):
+                pass
+
+
+_publisher = None
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Returns the CommandPublisher of the current process."""
+    global _publisher, _publisher_pid
+
+    with _publisher_lock:
+        # Connections can't be shared with child processes created by servers that fork their workers.
+        if _publisher is None or _publisher_pid != os.getpid():
+            config = broker_settings()
+            _publisher = CommandPublisher(host=config['HOST'], queue=config['REQUESTS_QUEUE'],
+                                          connect_timeout=config['CONNECT_TIMEOUT'],
+                                          retry_interval=config['RETRY_INTERVAL'])
+            _publisher_pid = os.getpid()
+        return _publisher
@@ -2,44 +2,171 @@
 
 """Module which processes responses received from the bot."""
 
+import time, uuid
+
 import pika
 
-from django.db import DatabaseError
-from django.db.models import ObjectDoesNotExist
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Case, TextField, Value, When
 from django.utils import timezone
 
+from .notifications import hub
+from .publisher import broker_settings
+from .replies import render_reply
 from .utils import logger
 
+DEFAULT_RECEIVER_SETTINGS = {
+    # Start a receiver in a thread of every Django process. Disable it to run the receivers separately
+    # with "manage.py run_bot_receiver".
+    'RUN_IN_PROCESS': True,
+    # Maximum number of responses saved to the database in a single transaction.
+    'BATCH_SIZE': 50,
+    # Maximum number of seconds a response waits for its batch to be completed before it is saved.
+    'BATCH_TIMEOUT': 0.2,
+}
+
+
+def receiver_settings():
+    result = dict(DEFAULT_RECEIVER_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_RECEIVER', {}))
+    return result
+
 
 class BotReceiver(object):
+    """
+    Consumes the responses of the bot and saves them in the commands table. Responses are collected until
+    there are BATCH_SIZE of them or the oldest one waited BATCH_TIMEOUT seconds, and the whole batch is
+    saved in one transaction. Messages are acknowledged after the transaction is committed, so responses
+    are not lost if the process dies.
+    """
 
-    def __init__(self):
-        # TODO: Add connection parameters like hostname, queue name, etc to settings.py
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+    # Maximum number of commands read or updated by a single query. The update takes 5 parameters per
+    # command, and SQLite doesn't accept more than 999 in a query.
+    QUERY_CHUNK_SIZE = 150
+
+    def __init__(self, batch_size=None, batch_timeout=None):
+        config = receiver_settings()
+        self.batch_size = batch_size or config['BATCH_SIZE']
+        self.batch_timeout = batch_timeout if batch_timeout is not None else config['BATCH_TIMEOUT']
+        self._batch = []
+        self._batch_started = None
+
+        broker = broker_settings()
+        self.connection = pika.BlockingConnection(pika.ConnectionParameters(host=broker['HOST']))
         self.channel = self.connection.channel()
-        self.channel.queue_declare(queue='bot_responses')
-        self.channel.basic_qos(prefetch_count=1)
-        self.channel.basic_consume(self.process_response, queue='bot_responses', no_ack=True)
+        self.channel.queue_declare(queue=broker['RESPONSES_QUEUE'])
+        self.channel.basic_qos(prefetch_count=self.batch_size)
+        self.channel.basic_consume(self.process_response, queue=broker['RESPONSES_QUEUE'], no_ack=False)
 
+    def start(self):
         logger.info('Bot receiver started. Waiting for incomming messages...')
-        self.channel.start_consuming()
+
+        while True:
+            if self._batch:
+                time_limit = max(0, self._batch_started + self.batch_timeout - time.monotonic())
+            else:
+                time_limit = self.batch_timeout
+            self.connection.process_data_events(time_limit=time_limit)
+
+            if self._batch and time.monotonic() >= self._batch_started + self.batch_timeout:
+                self.flush()
 
     def process_response(self, ch, method, props, body):
         """
-        Receives the response from the bot, and saves it in the commands table, so a user can retrieve them
-        later.
+        Receives the response from the bot, and adds it to the current batch. The batch is saved when it is
+        full, or by the consumer loop when its timeout expires.
         """
         logger.debug('Response message received (corr_id=%s): %r', props.correlation_id, body)
 
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        self._batch.append((method.delivery_tag, props.correlation_id, body))
+
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Saves the responses of the current batch, and acknowledges them."""
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        last_delivery_tag = batch[-1][0]
+
+        try:
+            close_old_connections()
+            BotReceiver.save_responses([(correlation_id, body) for _, correlation_id, body in batch])
+        except Exception as e:
+            logger.error('Error when updating response records! They will be received again.')
+            logger.exception(e)
+            self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True, requeue=True)
+            # Don't receive the same batch again immediately if the database is down.
+            self.connection.sleep(1)
+            return
+
+        self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+
+    @staticmethod
+    def save_responses(responses):
+        """
+        Saves a list of (correlation_id, body) responses in the commands table in a single transaction,
+        with one query to find the commands and one update for every QUERY_CHUNK_SIZE of them. The chat
+        messages of every response are rendered here, so they are not built again every time the user asks
+        for updates. The users waiting for updates are notified after the commit.
+        """
+        # Import is needed here to avoid error "Apps arent't loaded yet at Django startup."
+        from .models import CommandMessage
+
+        bodies = {}
+
+        for correlation_id, body in responses:
+            try:
+                bodies[uuid.UUID(correlation_id)] = body.decode()
+            except (TypeError, ValueError, AttributeError):
+                logger.error('Response with invalid correlation id %r discarded.', correlation_id)
+
+        if not bodies:
+            return
+
+        chunk_size = BotReceiver.QUERY_CHUNK_SIZE
+        uuids = list(bodies)
+
+        with transaction.atomic():
+            commands = {}
+
+            for i in range(0, len(uuids), chunk_size):
+                commands.update((command_uuid, (user_id, request)) for command_uuid, user_id, request in
+                                CommandMessage.objects.filter(uuid__in=uuids[i:i + chunk_size]).order_by()
+                                .values_list('uuid', 'user_id', 'request'))
+
+            for missing in set(bodies) - set(commands):
+                logger.error('Message with uuid %s not found in the database!', missing)
+
+            if commands:
+                date_answered = timezone.now()
+                found = list(commands)
+
+                for i in range(0, len(found), chunk_size):
+                    chunk = found[i:i + chunk_size]
+                    responses = [When(uuid=command_uuid, then=Value(bodies[command_uuid]))
+                                 for command_uuid in chunk]
+                    rendered = [When(uuid=command_uuid, then=Value(
+                        render_reply(commands[command_uuid][1], bodies[command_uuid], date_answered)))
+                        for command_uuid in chunk]
+                    (CommandMessage.objects.filter(uuid__in=chunk)
+                     .update(date_answered=date_answered, response=Case(*responses, output_field=TextField()),
+                             rendered=Case(*rendered, output_field=TextField())))
+
+                user_ids = set(user_id for user_id, _ in commands.values())
+                transaction.on_commit(lambda: hub.notify_user(user_ids))
+
+def run_bot_receiver(batch_size=None, batch_timeout=None, retry_delay=5):
+    """Runs a BotReceiver, creating a new one if the connection to RabbitMQ is lost."""
+    while True:
         try:
-            # Import is needed here to avoid error "Apps arent't loaded yet at Django startup."
-            from .models import CommandMessage
-            command_rec = CommandMessage.objects.get(uuid=props.correlation_id)
-            command_rec.date_answered = timezone.now()
-            command_rec.response = body.decode()
-            command_rec.save(force_update=True, update_fields=['date_answered', 'response'])
-        except ObjectDoesNotExist:
-            logger.error('Message with uuid %s not found in the database!', props.correlation_id)
+            BotReceiver(batch_size=batch_size, batch_timeout=batch_timeout).start()
         except Exception as e:
-            logger.error('Error when updating response record!')
+            logger.error('Bot receiver stopped. Restarting in %d seconds...', retry_delay)
             logger.exception(e)
+            time.sleep(retry_delay)
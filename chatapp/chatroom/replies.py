@@ -0,0 +1,55 @@
+# encoding: utf-8
+
+"""Conversion of the answers of the bot to the messages shown in the chat."""
+
+import json
+
+from .utils import datetime_aware_to_str, logger
+
+BOT_USER = {'id': 0, 'username': 'Bot'}
+
+
+def render_reply(request, response, date_answered):
+    """
+    Returns the JSON array with the chat messages that show the answer of the bot to a command. It is done
+    once, when the answer is received, and the result is sent as it is to the browser.
+    """
+    timestamp = datetime_aware_to_str(date_answered)
+
+    try:
+        messages = _convert_response_to_messages(request, response, timestamp)
+    except (ValueError, TypeError, KeyError) as e:
+        logger.error('Error converting message to json.')
+        logger.error(e)
+        messages = [{'text': 'Error getting response from bot.', 'user': BOT_USER, 'type': 'command',
+                     'timestamp': timestamp}]
+
+    return json.dumps(messages)
+
+
+def _convert_response_to_messages(request, response, timestamp):
+    if response is None:
+        raise ValueError('Message sent to bot must contain an answer.')
+
+    response_json = json.loads(response)
+    if not isinstance(response_json, dict):
+        raise ValueError('Answer in wrong format!')
+
+    if response_json['error']:
+        return [_create_message(response_json['message'], timestamp, error=True)]
+
+    # Check which command this answer belongs to, in order to choose the response format.
+    request_json = json.loads(request)
+    if request_json['type'] == 'stock':
+        return [_create_message(response_json['message'], timestamp)]
+    elif request_json['type'] == 'day_range':
+        # Esta API devuelve un array de resultados.
+        return [_create_message(result['message'], timestamp, error=result['error'])
+                for result in response_json['results']]
+    else:
+        return [_create_message('Response to command {0} not implemented.'.format(request_json['type']),
+                                timestamp, error=True)]
+
+
+def _create_message(text, timestamp, error=False):
+    return {'text': text, 'user': BOT_USER, 'type': 'command', 'timestamp': timestamp, 'error': error}
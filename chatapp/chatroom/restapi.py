@@ -4,18 +4,23 @@
 JSON Views that implement a tiny REST API to get and post messages.
 """
 
-import json, pika, re
+import json, re, time, uuid
 
 from django.contrib.auth import get_user_model
-from django.contrib.sessions.models import Session
-from django.db import DatabaseError
-from django.http import JsonResponse
+from django.db import DatabaseError, transaction
+from django.db.models import Max, Min
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
 
+from .message_buffer import recent_messages
 from .models import Message, CommandMessage
+from .notifications import hub, long_poll_settings, stream_settings
+from .presence import presence_tracker
+from .replies import render_reply
+from .outbox import notify_new_command
 from .utils import logger
 from .views import AjaxView
-from .utils import datetime_aware_to_str, str_to_datetime_aware
+from .utils import decode_cursor, encode_cursor, join_json_arrays, str_to_datetime_aware
 
 
 class PostMessage(AjaxView):
@@ -47,6 +52,8 @@ class PostMessage(AjaxView):
             logger.exception(e)
             return self.create_error_response('Error saving message in database', code='DB01')
 
+        recent_messages.add(message_obj)
+        hub.notify_message()
         return JsonResponse(message_obj.to_json_safe_object())
 
     def _process_command(self, command, arg, user):
@@ -68,16 +75,8 @@ class PostMessage(AjaxView):
         return response
 
     def stock(self, arg, user):
-        # Save a record of the message to the database. The message's UUID is used as a correlation id
-        # in RabbitMQ to match it with its answer.
         request = json.dumps({'type': 'stock', 'arg': arg})
-        command_rec = CommandMessage.objects.create(date_posted=timezone.now(), request=request, user=user)
-        command_rec.save()
-
-        self._send_request(str(command_rec.uuid), request)
-
-        response_obj = {'type': 'command', 'status': 'queued', 'error': False}
-        return JsonResponse(response_obj)
+        return self._queue_command(request, user)
 
     def day_range(self, arg, user):
         # This command allows to query data from various companies at once.
@@ -88,28 +87,20 @@ class PostMessage(AjaxView):
         else:
             companies = arg
         request = json.dumps({'type': 'day_range', 'arg': companies})
-        command_rec = CommandMessage(date_posted=timezone.now(), request=request, user=user)
-        command_rec.save()
+        return self._queue_command(request, user)
 
-        self._send_request(str(command_rec.uuid), request)
+    def _queue_command(self, request, user):
+        # Save a record of the message to the database as pending. The outbox dispatcher sends it to the bot
+        # after the transaction is committed, using the message's UUID as a correlation id in RabbitMQ to
+        # match it with its answer.
+        with transaction.atomic():
+            CommandMessage.objects.create(date_posted=timezone.now(), request=request, user=user,
+                                          dispatch_status=CommandMessage.DISPATCH_PENDING)
+            transaction.on_commit(notify_new_command)
 
         response_obj = {'type': 'command', 'status': 'queued', 'error': False}
         return JsonResponse(response_obj)
 
-    def _send_request(self, correlation_id, request):
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-
-        try:
-            channel = connection.channel()
-            channel.queue_declare(queue='bot_requests')
-
-            logger.debug('Sending message (corr_id={0}) to queue bot_requests: {1}'.format(
-                correlation_id, request))
-            channel.basic_publish(exchange='', routing_key='bot_requests', body=request,
-                                  properties=pika.BasicProperties(correlation_id=correlation_id))
-        finally:
-            connection.close()
-
 
 class GetLastMessages(AjaxView):
 
@@ -125,17 +116,94 @@ class GetLastMessages(AjaxView):
         else:
             number_records = 50
 
-        messages = Message.objects.order_by('-date_posted')[:number_records]
+        try:
+            # The last messages are usually in memory, and identified by their ids. Otherwise they are read
+            # from the database, and the list only changes when messages are posted or deleted.
+            message_list = recent_messages.last(number_records)
+
+            if message_list is not None:
+                etag = self.make_etag('messages', number_records, *[m['id'] for m in message_list])
+                return self.conditional_response(request, etag,
+                                                 lambda: JsonResponse(message_list, safe=False))
+
+            ids = Message.objects.aggregate(first_id=Min('id'), last_id=Max('id'))
+            etag = self.make_etag('messages', number_records, ids['first_id'], ids['last_id'])
+            return self.conditional_response(request, etag, lambda: self._get_messages(number_records))
+        except DatabaseError as e:
+            logger.error('Error reading messages from database.')
+            logger.exception(e)
+            return self.create_error_response('Could not get messages from database.', code='DB01')
+
+    def _get_messages(self, number_records):
+        messages = Message.objects.select_related('user').order_by('-date_posted')[:number_records]
+        return JsonResponse([m.to_json_safe_object() for m in reversed(list(messages))], safe=False)
+
+
+class MessageHistory(AjaxView):
+    """
+    Returns a page of the message history, for scrolling through it. Pages are selected with the opaque
+    cursors returned by previous pages: "before" returns the messages older than the cursor, and "after"
+    the newer ones. Without a cursor, the last page is returned.
+
+    Messages are ordered by (date_posted, id), which is unique even when two messages have the same date,
+    and each page is read from the index in that order, so the cost of a page doesn't depend on how far
+    it is in the history.
+    """
+
+    DEFAULT_PAGE_SIZE = 50
+    MAX_PAGE_SIZE = 100
+
+    def get(self, request, *args, **kwargs):
+        try:
+            page_size = int(request.GET.get('count', self.DEFAULT_PAGE_SIZE))
+        except (ValueError, TypeError):
+            page_size = self.DEFAULT_PAGE_SIZE
+        page_size = max(1, min(page_size, self.MAX_PAGE_SIZE))
+
+        before, after = request.GET.get('before', None), request.GET.get('after', None)
+
+        try:
+            # The range on date_posted bounds the scan of the index. The messages with the same date as the
+            # cursor that were already returned are excluded, instead of using an OR of both conditions,
+            # which databases can't use to seek in the index.
+            if after:
+                date_posted, message_id = decode_cursor(after)
+                qs = (Message.objects.filter(date_posted__gte=date_posted)
+                      .exclude(date_posted=date_posted, id__lte=message_id).order_by('date_posted', 'id'))
+            else:
+                qs = Message.objects.order_by('-date_posted', '-id')
+                if before:
+                    date_posted, message_id = decode_cursor(before)
+                    qs = qs.filter(date_posted__lte=date_posted).exclude(date_posted=date_posted,
+                                                                         id__gte=message_id)
+        except ValueError:
+            return self.create_error_response('Invalid cursor.', status=400)
 
         try:
-            messages = reversed(list(messages))
+            # One more message is read to know if there are more pages in that direction.
+            messages = list(qs.select_related('user')[:page_size + 1])
         except DatabaseError as e:
             logger.error('Error reading messages from database.')
             logger.exception(e)
             return self.create_error_response('Could not get messages from database.', code='DB01')
 
-        message_list = [m.to_json_safe_object() for m in messages]
-        return JsonResponse(message_list, safe=False)
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+        if not after:
+            messages.reverse()
+
+        # Cursors to continue before and after the page. "before" is null when there are no older messages.
+        # "after" is always given if possible, because newer messages can be posted later.
+        before_cursor, after_cursor = after, after or before
+
+        if messages:
+            first, last = messages[0], messages[-1]
+            before_cursor = encode_cursor(first.date_posted, first.id) if after or has_more else None
+            after_cursor = encode_cursor(last.date_posted, last.id)
+
+        response_obj = {'messages': [m.to_json_safe_object() for m in messages], 'before': before_cursor,
+                        'after': after_cursor}
+        return JsonResponse(response_obj)
 
 
 class GetUpdates(AjaxView):
@@ -147,105 +215,276 @@ class GetUpdates(AjaxView):
 
     def get(self, request, *args, **kwargs):
         last_timestamp_str = request.GET.get('last_t', None)
-        message_list = []
+        last_timestamp = None
+
+        if last_timestamp_str:
+            try:
+                last_timestamp = str_to_datetime_aware(last_timestamp_str)
+                if last_timestamp is None:
+                    raise ValueError('Invalid date format.')
+            except ValueError as e:
+                logger.error('Error parsing date')
+                logger.exception(e)
+                return self.create_error_response('Invalid date: ' + last_timestamp_str, status=400)
+
+        # With the "wait" parameter, the request waits up to that number of seconds for new messages
+        # when there are none yet (long polling).
+        try:
+            wait = min(float(request.GET.get('wait', 0)), long_poll_settings()['MAX_WAIT'])
+        except (ValueError, TypeError):
+            wait = 0
 
+        # The answers of the bot are marked as read when they are sent, so this endpoint doesn't answer
+        # conditional requests: a cached answer would show them again, and hide the new ones.
         try:
-            if last_timestamp_str:
-                try:
-                    last_timestamp = str_to_datetime_aware(last_timestamp_str)
-                    # Avoid attacks. If the database is big and a very old timestamp is sent, like
-                    # 1900-01-01, return a maximum of 100 last messages.
-                    qs = Message.objects.filter(date_posted__gt=last_timestamp).order_by('-date_posted')[:100]
-                    messages = reversed(list(qs))
-                    message_list.extend([m.to_json_safe_object() for m in messages])
-                except ValueError as e:
-                    logger.error('Error parsing date')
-                    logger.exception(e)
-                    return self.create_error_response('Invalid date: ' + last_timestamp_str, status=400)
-
-            # Get pending messages for the current user.
-            bot_messages = (CommandMessage.objects.filter(user=request.user, date_answered__isnull=False,
-                                                          read=False)
-                            .order_by('-date_posted'))
-            bot_messages = reversed(list(bot_messages))
-
-            for message in bot_messages:
-                try:
-                    message_list.extend(self._convert_response_to_message(message))
-                except (ValueError, TypeError, KeyError) as e:
-                    logger.error('Error converting message to json.')
-                    logger.error(e)
-                    message_list.append({'text': 'Error getting response from bot.',
-                                         'user': {'id': 0, 'username': 'Bot'}, 'type': 'command',
-                    'timestamp': datetime_aware_to_str(message.date_answered)})
-
-            (CommandMessage.objects.filter(user=request.user, date_answered__isnull=False, read=False)
-             .update(read=True))
+            # The version is taken before querying, so a message saved in between wakes up the wait.
+            version = hub.version(request.user.id)
+            message_list, replies = self._get_updates(request.user, last_timestamp)
+
+            if not message_list and not replies and wait > 0 and hub.wait(request.user.id, version, wait):
+                message_list, replies = self._get_updates(request.user, last_timestamp)
         except Exception as e:
             logger.error('Error getting pending messages for the user.')
             logger.exception(e)
             return self.create_error_response('Error getting messages from database. Contact system '
                                               'administrator for more information.', status=500)
 
-        return JsonResponse(message_list, safe=False)
+        return self._create_updates_response(message_list, replies)
+
+    @staticmethod
+    def _create_updates_response(message_list, replies):
+        # The answers of the bot are already JSON, and are added to the list as they are.
+        content = join_json_arrays([json.dumps(message_list)] + replies)
+        response = HttpResponse(content, content_type='application/json')
+        response['Cache-Control'] = 'no-store'
+        return response
 
-    def _convert_response_to_message(self, command_message):
-        if command_message.response is None:
-            raise ValueError('Message sent to bot must contain an answer.')
+    def _get_updates(self, user, last_timestamp):
+        """
+        Returns the messages posted after last_timestamp, and the JSON arrays with the unread responses of
+        the bot.
+        """
+        message_list = []
 
-        response_json = json.loads(command_message.response)
-        if not isinstance(response_json, dict):
-            raise ValueError('Message {0} has answer in wrong format!'.format(command_message.uuid))
+        if last_timestamp:
+            # Avoid attacks. If the database is big and a very old timestamp is sent, like
+            # 1900-01-01, return a maximum of 100 last messages.
+            recent = recent_messages.since(last_timestamp, 100)
 
-        if response_json['error']:
-            return [self._create_message_error_response(response_json['message'], command_message)]
+            if recent is not None:
+                message_list.extend(recent)
+            else:
+                qs = (Message.objects.select_related('user').filter(date_posted__gt=last_timestamp)
+                      .order_by('-date_posted')[:100])
+                messages = reversed(list(qs))
+                message_list.extend([m.to_json_safe_object() for m in messages])
 
-        # Check which command this answer belongs to, in order to choose the response format.
-        request_json = json.loads(command_message.request)
-        if request_json['type'] == 'stock':
-            return [{'text': response_json['message'], 'user': {'id': 0, 'username': 'Bot'},
-                     'type': 'command', 'error': False,
-                     'timestamp': datetime_aware_to_str(command_message.date_answered)}]
-        elif request_json['type'] == 'day_range':
-            # Esta API devuelve un array de resultados.
-            results = response_json['results']
-            messages = []
+        return message_list, self._get_bot_replies(user)
+
+    def _get_bot_replies(self, user):
+        """
+        Returns the unread responses of the bot to the user's commands, and marks them as read. Every
+        response is a JSON array with its chat messages.
+        """
+        replies = []
+
+        # The answers are claimed and marked as read in one statement, and then the claimed ones are read.
+        # An answer saved meanwhile is left for the next request, and concurrent requests of the same user
+        # never get the same answers.
+        token = uuid.uuid4()
+        if not self._unread_replies(user).update(read=True, delivery_token=token):
+            return replies
+
+        bot_messages = (CommandMessage.objects.filter(delivery_token=token).order_by('date_posted')
+                        .values_list('rendered', 'request', 'response', 'date_answered'))
+
+        for rendered, command_request, response, date_answered in bot_messages:
+            # Answers saved before they were rendered by the receiver are rendered now.
+            replies.append(rendered or render_reply(command_request, response, date_answered))
+
+        return replies
 
-            for result in results:
-                if result['error']:
-                    messages.append(self._create_message_error_response(result['message'], command_message))
-                else:
-                    messages.append({'text': result['message'], 'user': {'id': 0, 'username': 'Bot'},
-                                     'type': 'command', 'error': False,
-                                     'timestamp': datetime_aware_to_str(command_message.date_answered)})
+    @staticmethod
+    def _unread_replies(user):
+        return CommandMessage.objects.filter(user=user, date_answered__isnull=False, read=False)
 
-            return messages
+
+class MessageStream(GetUpdates):
+    """
+    Sends new messages and the responses of the bot to the browser as Server-Sent Events, through a
+    connection kept open. Each chat message is sent with its id as event id, so a browser that reconnects
+    continues from the Last-Event-ID header. Comments are sent as heartbeats while there is nothing new,
+    and the stream is closed after MAX_DURATION seconds to release the server thread; the browser opens it
+    again automatically.
+    """
+
+    # Maximum number of messages read from the database at once.
+    BATCH_SIZE = 100
+
+    def get(self, request, *args, **kwargs):
+        # The browser sends Last-Event-ID when it reconnects. The first time, the id of the last message
+        # shown is given in the query string.
+        last_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_id', None)
+
+        if last_id:
+            try:
+                last_id = int(last_id)
+            except (ValueError, TypeError):
+                return self.create_error_response('Invalid event id: ' + last_id, status=400)
         else:
-            return [self.create_error_response('Response to command {0} not implemented.'
-                                               .format(request_json['type']))]
+            last_message = Message.objects.order_by('-id').values_list('id', flat=True).first()
+            last_id = last_message or 0
+
+        response = StreamingHttpResponse(self._stream_events(request.user, last_id),
+                                         content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Don't let nginx buffer the events.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def _stream_events(self, user, last_id):
+        config = stream_settings()
+        deadline = time.monotonic() + config['MAX_DURATION']
+        yield 'retry: {0}\n\n'.format(config['RETRY'])
 
-    def _create_message_error_response(self, error_msg, command_message):
-        res_obj = {'text': error_msg, 'user': {'id': 0, 'username': 'Bot'}, 'type': 'command',
-                   'timestamp': datetime_aware_to_str(command_message.date_answered), 'error': True}
-        return res_obj
+        while time.monotonic() < deadline:
+            try:
+                version = hub.version(user.id)
+                messages = list(Message.objects.select_related('user').filter(id__gt=last_id)
+                                .order_by('id')[:self.BATCH_SIZE])
+                events = []
+
+                for message in messages:
+                    events.append(self._format_event(message.to_json_safe_object(), event_id=message.id))
+                    last_id = message.id
+
+                # Every answer of the bot is sent in one event, with the array of its messages.
+                events.extend('data: {0}\n\n'.format(reply) for reply in self._get_bot_replies(user))
+            except Exception as e:
+                # The browser reconnects and continues from the last event it received.
+                logger.error('Error getting messages for the event stream.')
+                logger.exception(e)
+                return
+
+            if events:
+                yield ''.join(events)
+            else:
+                timeout = min(config['HEARTBEAT'], max(0, deadline - time.monotonic()))
+                if not hub.wait(user.id, version, timeout):
+                    yield ': heartbeat\n\n'
+
+    @staticmethod
+    def _format_event(data, event_id=None):
+        event = 'data: {0}\n\n'.format(json.dumps(data))
+        if event_id is not None:
+            event = 'id: {0}\n'.format(event_id) + event
+        return event
+
+
+class Sync(GetUpdates):
+    """
+    Returns in one request everything the chat page needs to update itself: the messages after the id given
+    in "after", the unread responses of the bot, and the changes of the online users after the version given
+    in "presence" (see GetOnlineUserChanges). The answer includes the new message cursor and presence
+    version, to be sent in the next request.
+
+    Like GetUpdates, the "wait" parameter makes the request wait up to that number of seconds when there is
+    nothing new. Users that stopped making requests are only seen leaving at the next request.
+    """
+
+    # Maximum number of messages returned at once.
+    BATCH_SIZE = 100
+
+    def get(self, request, *args, **kwargs):
+        try:
+            after = int(request.GET['after']) if request.GET.get('after') else None
+            presence_version = int(request.GET['presence']) if request.GET.get('presence') else None
+        except ValueError:
+            return self.create_error_response('Invalid message cursor or presence version.', status=400)
+
+        try:
+            wait = min(float(request.GET.get('wait', 0)), long_poll_settings()['MAX_WAIT'])
+        except (ValueError, TypeError):
+            wait = 0
+
+        try:
+            version = hub.version(request.user.id)
+            response_obj = self._sync(request.user, after, presence_version)
+
+            if wait > 0 and self._is_empty(response_obj, after, presence_version) and \
+                    hub.wait(request.user.id, version, wait):
+                response_obj = self._sync(request.user, after, presence_version)
+        except Exception as e:
+            logger.error('Error getting the updates of the chat.')
+            logger.exception(e)
+            return self.create_error_response('Error getting messages from database. Contact system '
+                                              'administrator for more information.', status=500)
+
+        # The answers of the bot are already JSON, and are added as they are.
+        content = '{{"messages": {0}, "cursor": {1}, "replies": {2}, "presence": {3}}}'.format(
+            json.dumps(response_obj['messages']), json.dumps(response_obj['cursor']),
+            join_json_arrays(response_obj['replies']), json.dumps(response_obj['presence']))
+        return HttpResponse(content, content_type='application/json')
+
+    def _sync(self, user, after, presence_version):
+        if after is None:
+            # The first time, only the cursor is returned. The messages before it are read from the history.
+            messages = []
+            cursor = Message.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        else:
+            messages = list(Message.objects.select_related('user').filter(id__gt=after)
+                            .order_by('id')[:self.BATCH_SIZE])
+            cursor = messages[-1].id if messages else after
+
+        return {'messages': [m.to_json_safe_object() for m in messages], 'cursor': cursor,
+                'replies': self._get_bot_replies(user),
+                'presence': get_presence_changes(user, presence_version)}
+
+    @staticmethod
+    def _is_empty(response_obj, after, presence_version):
+        presence = response_obj['presence']
+        return (after is not None and not response_obj['messages'] and not response_obj['replies'] and
+                not presence['full'] and presence['version'] == presence_version)
 
 
 class GetOnlineUsers(AjaxView):
 
     def get(self, request, *args, **kwargs):
-        active_sessions = Session.objects.filter(expire_date__gte=timezone.now())
-        user_ids = []
+        # The version changes every time a user joins or leaves.
+        etag = self.make_etag('online', presence_tracker.version())
+        return self.conditional_response(request, etag, lambda: self._get_users(request.user))
+
+    def _get_users(self, current_user):
+        user_ids = [uid for uid in presence_tracker.online_user_ids(expire=False) if uid != current_user.id]
+        return JsonResponse(get_user_entries(user_ids), safe=False)
+
+
+class GetOnlineUserChanges(AjaxView):
+    """
+    Returns the users that joined and left the chat after the version of the list of online users given in
+    the "version" parameter, and the new version. If the version is not given or is too old, "full" is
+    true and "joined" has all the users online.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            since_version = int(request.GET['version'])
+        except (KeyError, ValueError, TypeError):
+            since_version = None
+
+        return JsonResponse(get_presence_changes(request.user, since_version))
 
-        for session in active_sessions:
-            data = session.get_decoded()
-            uid = data.get('_auth_user_id', None)
-            if uid and int(uid) != request.user.id:
-                user_ids.append(uid)
 
-        users = get_user_model().objects.filter(id__in=user_ids)
-        res = []
+def get_user_entries(user_ids):
+    """Returns the id and name of the given users, to show them in the list of online users."""
+    users = get_user_model().objects.filter(id__in=user_ids).order_by('id')
+    return [{'id': user.id, 'name': user.get_full_name()} for user in users]
 
-        for user in users:
-            res.append({'id': user.id, 'name': user.get_full_name()})
 
-        return JsonResponse(res, safe=False)
+def get_presence_changes(current_user, since_version):
+    """Returns the changes of the list of online users after since_version, without the current user."""
+    changes = presence_tracker.changes(since_version)
+    joined = [uid for uid in changes['joined'] if uid != current_user.id]
+    left = [uid for uid in changes['left'] if uid != current_user.id]
+    return {'version': changes['version'], 'full': changes['full'], 'joined': get_user_entries(joined),
+            'left': left}
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+"""Removal of old data, so the tables used by the chat stay small."""
+
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .utils import logger
+
+DEFAULT_RETENTION_SETTINGS = {
+    # Run the cleanup periodically in a thread of the Django process. Enable it in one process only, or run
+    # "manage.py prune_chat_data" periodically instead.
+    'RUN_IN_PROCESS': False,
+    # Seconds between cleanups, when they run in the process.
+    'INTERVAL': 3600,
+    # Days after which commands whose answer was already sent to the user are deleted.
+    'COMMANDS_MAX_AGE_DAYS': 7,
+    # Days after which messages are moved to the archive table.
+    'MESSAGES_MAX_AGE_DAYS': 90,
+    # Maximum number of rows deleted or moved in a single transaction.
+    'BATCH_SIZE': 500,
+}
+
+
+def retention_settings():
+    result = dict(DEFAULT_RETENTION_SETTINGS)
+    result.update(getattr(settings, 'CHATROOM_RETENTION', {}))
+    return result
+
+
+class RetentionPolicy(object):
+    """
+    Deletes the commands already delivered to the users and moves the old messages to the ArchivedMessage
+    table. Rows are processed in batches of BATCH_SIZE, each one in its own transaction, so the tables are
+    never locked for long. Archived messages are no longer returned by the chat's API.
+    """
+
+    def __init__(self, commands_max_age_days=7, messages_max_age_days=90, batch_size=500):
+        if batch_size < 1:
+            raise ValueError('The batch size must be at least 1.')
+        if commands_max_age_days < 0 or messages_max_age_days < 0:
+            raise ValueError('The maximum ages can\'t be negative.')
+
+        self.commands_max_age_days = commands_max_age_days
+        self.messages_max_age_days = messages_max_age_days
+        self.batch_size = batch_size
+
+    def run(self, dry_run=False):
+        """
+        Removes the old data. With dry_run, nothing is changed. Returns a dict with the number of commands
+        deleted and messages archived, or that would be with dry_run.
+        """
+        now = timezone.now()
+        commands_cutoff = now - timezone.timedelta(days=self.commands_max_age_days)
+        messages_cutoff = now - timezone.timedelta(days=self.messages_max_age_days)
+
+        if dry_run:
+            return {'commands': self._old_commands(commands_cutoff).count(),
+                    'messages': self._old_messages(messages_cutoff).count()}
+
+        return {'commands': self._in_batches(lambda: self._delete_commands(commands_cutoff)),
+                'messages': self._in_batches(lambda: self._archive_messages(messages_cutoff, now))}
+
+    def _in_batches(self, process_batch):
+        total = 0
+
+        while True:
+            count = process_batch()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def _delete_commands(self, cutoff):
+        from .models import CommandMessage
+
+        with transaction.atomic():
+            uuids = list(self._old_commands(cutoff).order_by('date_posted')
+                         .values_list('uuid', flat=True)[:self.batch_size])
+            if uuids:
+                CommandMessage.objects.filter(uuid__in=uuids).delete()
+        return len(uuids)
+
+    def _archive_messages(self, cutoff, date_archived):
+        from .models import ArchivedMessage, Message
+
+        with transaction.atomic():
+            messages = list(self._old_messages(cutoff).order_by('date_posted', 'id')[:self.batch_size])
+            if messages:
+                ArchivedMessage.objects.bulk_create([
+                    ArchivedMessage(id=m.id, user_id=m.user_id, date_posted=m.date_posted, text=m.text,
+                                    date_archived=date_archived) for m in messages])
+                Message.objects.filter(id__in=[m.id for m in messages]).delete()
+        return len(messages)
+
+    @staticmethod
+    def _old_commands(cutoff):
+        from .models import CommandMessage
+        return CommandMessage.objects.filter(read=True, date_posted__lt=cutoff)
+
+    @staticmethod
+    def _old_messages(cutoff):
+        from .models import Message
+        return Message.objects.filter(date_posted__lt=cutoff)
+
+
+def create_retention_policy(**options):
+    """Returns a RetentionPolicy with the settings of CHATROOM_RETENTION, replaced by the given options."""
+    config = retention_settings()
+    kwargs = {'commands_max_age_days': config['COMMANDS_MAX_AGE_DAYS'],
+              'messages_max_age_days': config['MESSAGES_MAX_AGE_DAYS'], 'batch_size': config['BATCH_SIZE']}
+    kwargs.update((key, value) for key, value in options.items() if value is not None)
+    return RetentionPolicy(**kwargs)
+
+
+class RetentionScheduler(object):
+    """Runs the retention policy every INTERVAL seconds."""
+
+    def __init__(self, policy, interval=3600):
+        self.policy = policy
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        logger.info('Retention scheduler started.')
+
+        while not self._stopped.is_set():
+            try:
+                close_old_connections()
+                result = self.policy.run()
+                logger.info('Deleted %d old commands and archived %d old messages.', result['commands'],
+                            result['messages'])
+            except Exception as e:
+                logger.error('Error removing old data.')
+                logger.exception(e)
+
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
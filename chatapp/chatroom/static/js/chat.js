@@ -2,6 +2,10 @@
 
 var Chat = {
     messageToSend: '',
+    // Seconds the server may hold a request for updates, and milliseconds to wait after a failed one. The
+    // requests also keep the user online, so the wait must be shorter than the presence timeout.
+    updatesWait: 20,
+    updatesRetryDelay: 3000,
 
     init: function() {
         this.cacheDOM();
@@ -18,102 +22,193 @@ var Chat = {
         this.$userList = $('#user-list');
         this.myUserId = parseInt($('#user_id').val());
         this.messagesUrl = $('#messages_url').val();
-        this.updatesUrl = $('#updates_url').val();
+        this.historyUrl = $('#history_url').val();
         this.onlineUrl = $('#online_url').val();
+        this.syncUrl = $('#sync_url').val();
         this.lastTimestamp = null;
+        // Ids of the messages already shown. A message posted by this user can arrive both in the answer
+        // of the post and in the long polling request.
+        this.shownMessageIds = {};
+        this.lastMessageId = null;
+        // Id of the last message received through the sync requests.
+        this.syncCursor = null;
+        // Cursor to the messages older than the ones shown, or null if there are no more.
+        this.historyCursor = null;
+        this.loadingHistory = false;
         this.updatesTimer = null;
-        this.updateOnlineTimer = null;
+        // Version of the list of online users shown.
+        this.presenceVersion = null;
     },
 
     bindEvents: function() {
         this.$button.on('click', this.sendMessage.bind(this));
         this.$textarea.on('keyup', this.sendMessageEnter.bind(this));
+        this.$chatHistory.on('scroll', this.loadOlderMessagesOnScroll.bind(this));
     },
 
     render: function() {
         var thisInstance = this;
         $.ajax({
-            url: this.messagesUrl,
+            url: this.historyUrl,
             type: 'GET',
             dataType: 'json'
         }).done(function(response) {
-            if ($.isArray(response)) {
-                for(var i = 0; i < response.length; i++) {
-                    thisInstance.$chatHistoryList.append(thisInstance._createMessageMarkup(response[i]));
-                    thisInstance.lastTimestamp = response[i].timestamp;
+            if (response && $.isArray(response.messages)) {
+                var messages = response.messages;
+                for(var i = 0; i < messages.length; i++) {
+                    thisInstance._appendMessage(messages[i]);
+                    thisInstance.lastTimestamp = messages[i].timestamp;
                 }
 
+                thisInstance.historyCursor = response.before;
                 thisInstance.scrollToBottom();
                 thisInstance.$textarea.val('');
             }
-            // Activar el timer que consulta al servidor por mensajes nuevos.
-            thisInstance.updatesTimer = setInterval($.proxy(thisInstance.getUpdates, thisInstance), 1000);
         }).fail(function(jqxhr) {
             if (jqxhr.responseJSON && jqxhr.responseJSON.message) {
                 thisInstance.$extraMsg.text(jqxhr.responseJSON.message);
             }
             thisInstance.$textarea.val('');
+        }).always(function() {
+            // Start receiving new messages and online users, even if the history could not be loaded.
+            thisInstance.syncCursor = thisInstance.lastMessageId;
+            thisInstance.sync();
         });
+    },
 
-        this.getOnlineUsers();
-        this.updateOnlineTimer = setInterval($.proxy(this.getOnlineUsers, this), 5000)
+    /**
+     * Asks the server for new messages, responses of the bot and changes of the online users, all in one
+     * request. The server holds the request until there is something new or the wait time expires, and a
+     * new request is made as soon as the previous one finishes.
+     */
+    sync: function() {
+        var thisInstance = this;
+        var data = {wait: this.updatesWait};
+
+        if (this.syncCursor !== null) {
+            data.after = this.syncCursor;
+        }
+        if (this.presenceVersion !== null) {
+            data.presence = this.presenceVersion;
+        }
+
+        $.ajax({
+            url: this.syncUrl,
+            type: 'GET',
+            dataType: 'json',
+            timeout: (this.updatesWait + 10) * 1000,
+            data: data
+        }).done(function(response) {
+            thisInstance.$extraMsg.empty();
+            $.each(response.messages || [], function(index, message) {
+                thisInstance._appendMessage(message);
+                thisInstance.lastTimestamp = message.timestamp;
+            });
+            $.each(response.replies || [], function(index, reply) {
+                thisInstance._appendMessage(reply);
+            });
+            thisInstance.syncCursor = response.cursor;
+            thisInstance.applyPresenceChanges(response.presence);
+            thisInstance.updatesTimer = setTimeout($.proxy(thisInstance.sync, thisInstance), 0);
+        }).fail(function(jqxhr) {
+            if (jqxhr.responseJSON && jqxhr.responseJSON.message) {
+                thisInstance.$extraMsg.text(jqxhr.responseJSON.message);
+            }
+            // Don't flood the server with requests while it is failing.
+            thisInstance.updatesTimer = setTimeout($.proxy(thisInstance.sync, thisInstance),
+                thisInstance.updatesRetryDelay);
+        });
     },
 
-    getUpdates: function() {
+    /**
+     * Loads the previous page of messages when the chat history is scrolled to the top.
+     */
+    loadOlderMessagesOnScroll: function() {
+        if (this.$chatHistory.scrollTop() > 50 || !this.historyCursor || this.loadingHistory) {
+            return;
+        }
+
         var thisInstance = this;
-        this.$extraMsg.empty();
+        this.loadingHistory = true;
         $.ajax({
-            url: this.updatesUrl,
+            url: this.historyUrl,
             type: 'GET',
             dataType: 'json',
             data: {
-                last_t: this.lastTimestamp || ''
+                before: this.historyCursor
             }
         }).done(function(response) {
-            if ($.isArray(response)) {
-                for (var i = 0; i < response.length; i++) {
-                    var message = response[i];
-                    thisInstance.$chatHistoryList.append(thisInstance._createMessageMarkup(message));
-                    thisInstance.scrollToBottom();
-                    if (message.type == 'message') {
-                        thisInstance.lastTimestamp = message.timestamp;
+            if (response && $.isArray(response.messages)) {
+                // Keep the messages being read at the same position of the screen.
+                var previousHeight = thisInstance.$chatHistory[0].scrollHeight;
+
+                for (var i = response.messages.length - 1; i >= 0; i--) {
+                    var message = response.messages[i];
+                    if (!thisInstance.shownMessageIds[message.id]) {
+                        thisInstance.shownMessageIds[message.id] = true;
+                        thisInstance.$chatHistoryList.prepend(thisInstance._createMessageMarkup(message));
                     }
                 }
+
+                thisInstance.historyCursor = response.before;
+                var $history = thisInstance.$chatHistory;
+                $history.scrollTop($history[0].scrollHeight - previousHeight + $history.scrollTop());
             }
-        }).fail(function(jqxhr) {
-            if (jqxhr.responseJSON && jqxhr.responseJSON.message) {
-                thisInstance.$extraMsg.text(jqxhr.responseJSON.message);
-            } else {
-                console && console.log(jqxhr.responseText);
-            }
-            thisInstance.$textarea.val('');
+        }).always(function() {
+            thisInstance.loadingHistory = false;
         });
     },
 
     renderMessage: function(messageInfo) {
         if (messageInfo.type == 'message') {
-            var item = this._createMessageMarkup(messageInfo);
-            this.$chatHistoryList.append(item);
-            this.scrollToBottom();
-            this.lastTimestamp = messageInfo.timestamp;
+            this._appendMessage(messageInfo);
+            if (!this.lastTimestamp || messageInfo.timestamp > this.lastTimestamp) {
+                this.lastTimestamp = messageInfo.timestamp;
+            }
         }
         this.$textarea.val('');
     },
 
-    getOnlineUsers: function() {
+    applyPresenceChanges: function(changes) {
+        if (!changes || changes.version === undefined) {
+            return;
+        }
+
         var thisInstance = this;
-        $.ajax({
-            url: this.onlineUrl,
-            type: 'GET',
-            dataType: 'json'
-        }).done(function(userList) {
-            thisInstance.$userList.empty();
-            if ($.isArray(userList)) {
-                $.each(userList, function(index, userInfo) {
-                    thisInstance.$userList.append(thisInstance._createOnlineUserEntry(userInfo));
-                });
+
+        // The full list is sent the first time, or when the version shown is too old.
+        if (changes.full) {
+            this.$userList.empty();
+        }
+
+        $.each(changes.left || [], function(index, userId) {
+            thisInstance.$userList.find('li[data-user-id="' + userId + '"]').remove();
+        });
+
+        $.each(changes.joined || [], function(index, userInfo) {
+            if (thisInstance.$userList.find('li[data-user-id="' + userInfo.id + '"]').length === 0) {
+                thisInstance.$userList.append(thisInstance._createOnlineUserEntry(userInfo));
             }
         });
+
+        this.presenceVersion = changes.version;
+    },
+
+    /**
+     * Adds a message at the end of the chat history, unless it was already shown.
+     * @param messageInfo Object with the information of the message to show.
+     * @private
+     */
+    _appendMessage: function(messageInfo) {
+        if (messageInfo.id) {
+            if (this.shownMessageIds[messageInfo.id]) {
+                return;
+            }
+            this.shownMessageIds[messageInfo.id] = true;
+            this.lastMessageId = Math.max(this.lastMessageId || 0, messageInfo.id);
+        }
+        this.$chatHistoryList.append(this._createMessageMarkup(messageInfo));
+        this.scrollToBottom();
     },
 
     /**
@@ -155,7 +250,7 @@ var Chat = {
     },
 
     _createOnlineUserEntry: function(onlineUserInfo) {
-        var item = $('<li/>').addClass('clearfix');
+        var item = $('<li/>').addClass('clearfix').attr('data-user-id', onlineUserInfo.id);
         item.append($('<img/>').attr({
             src: '/assets/img/user_avatar.png',
             alt: onlineUserInfo.name
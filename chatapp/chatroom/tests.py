@@ -1,3 +1,766 @@
-from django.test import TestCase
+# encoding: utf-8
 
-# Create your tests here.
+"""Test cases for the chatroom's REST API."""
+
+import io, json, threading, uuid
+
+from unittest import mock
+
+import pika
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models.query import QuerySet
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import chatroom
+
+from .apps import ChatroomConfig
+from .message_buffer import RecentMessages, recent_messages
+from .models import ArchivedMessage, CommandMessage, Message, Presence, PresenceEvent
+from .presence import presence_tracker
+from .notifications import NotificationHub, get_answered_users
+from .outbox import OutboxDispatcher
+from .publisher import BrokerUnavailableError, CommandPublisher
+from .receiver import BotReceiver, run_bot_receiver
+from .retention import RetentionPolicy
+
+
+class ChatroomTestCase(TestCase):
+
+    def setUp(self):
+        presence_tracker.clear()
+        self.user = get_user_model().objects.create_user('tester', password='secret1234567',
+                                                         first_name='Test', last_name='User')
+        self.client.force_login(self.user)
+        # The buffer is shared by all the tests, but their messages are rolled back. It is loaded on every
+        # read, to see the messages created directly in the database.
+        recent_messages.clear()
+        patcher = mock.patch.object(recent_messages, 'max_age', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@override_settings(CHATROOM_OUTBOX={'RUN_IN_PROCESS': False}, CHATROOM_RETENTION={'RUN_IN_PROCESS': False})
+class BackgroundThreadsTest(TestCase):
+
+    def _start_threads(self, argv):
+        """Runs the initialization of the app as the given command would, returning the threads started."""
+        with mock.patch('chatroom.apps.sys.argv', argv), \
+                mock.patch.object(recent_messages, 'size', 0), \
+                mock.patch('chatroom.apps.threading.Thread') as thread:
+            ChatroomConfig('chatroom', chatroom).ready()
+        return {c[1]['name']: c[1]['target'] for c in thread.call_args_list}
+
+    @override_settings(CHATROOM_RECEIVER={'RUN_IN_PROCESS': True})
+    def test_receiver_is_started_by_the_server(self):
+        self.assertEqual(self._start_threads(['manage.py', 'runserver']),
+                         {'bot-receiver-thread': run_bot_receiver})
+        self.assertEqual(self._start_threads(['gunicorn', 'project.wsgi']),
+                         {'bot-receiver-thread': run_bot_receiver})
+
+    @override_settings(CHATROOM_RECEIVER={'RUN_IN_PROCESS': True})
+    def test_receiver_is_not_started_by_management_commands(self):
+        self.assertEqual(self._start_threads(['manage.py', 'migrate']), {})
+        self.assertEqual(self._start_threads(['manage.py', 'run_bot_receiver']), {})
+
+    @override_settings(CHATROOM_RECEIVER={'RUN_IN_PROCESS': False})
+    def test_receiver_is_not_started_when_disabled(self):
+        self.assertEqual(self._start_threads(['manage.py', 'runserver']), {})
+
+
+class CommandPublisherTest(TestCase):
+
+    @mock.patch('chatroom.publisher.pika.BlockingConnection')
+    def test_connection_is_reused(self, connection_class):
+        publisher = CommandPublisher()
+        publisher.publish('1', '{}')
+        publisher.publish('2', '{}')
+        self.assertEqual(connection_class.call_count, 1)
+        self.assertEqual(connection_class.return_value.channel.return_value.basic_publish.call_count, 2)
+
+    @mock.patch('chatroom.publisher.pika.BlockingConnection')
+    def test_fails_fast_when_broker_is_down(self, connection_class):
+        connection_class.side_effect = pika.exceptions.AMQPConnectionError()
+        publisher = CommandPublisher(retry_interval=60)
+        self.assertRaises(BrokerUnavailableError, publisher.publish, '1', '{}')
+        self.assertRaises(BrokerUnavailableError, publisher.publish, '2', '{}')
+        # Keepalives don't try to connect again.
+        publisher.keepalive()
+        self.assertEqual(connection_class.call_count, 1)
+
+    @mock.patch('chatroom.publisher.pika.BlockingConnection')
+    def test_keepalive_processes_heartbeats(self, connection_class):
+        publisher = CommandPublisher()
+        publisher.keepalive()
+        self.assertEqual(connection_class.call_count, 0)
+        publisher.publish('1', '{}')
+        publisher.keepalive()
+        connection_class.return_value.process_data_events.assert_called_once_with(time_limit=0)
+
+
+class PostCommandTest(ChatroomTestCase):
+
+    def test_stock_command_is_saved_as_pending(self):
+        response = self.client.post(reverse('post'), {'message': '/stock=AAPL'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())['status'], 'queued')
+        command = CommandMessage.objects.get()
+        self.assertEqual(command.dispatch_status, CommandMessage.DISPATCH_PENDING)
+        self.assertEqual(json.loads(command.request), {'type': 'stock', 'arg': 'AAPL'})
+
+
+class OutboxDispatcherTest(ChatroomTestCase):
+
+    def _create_command(self):
+        return CommandMessage.objects.create(date_posted=timezone.now(), user=self.user,
+                                             request=json.dumps({'type': 'stock', 'arg': 'AAPL'}))
+
+    def test_pending_commands_are_sent(self):
+        commands = [self._create_command() for _ in range(3)]
+        publisher = mock.Mock()
+        dispatcher = OutboxDispatcher(batch_size=2, publisher=publisher)
+
+        self.assertEqual(dispatcher.dispatch_pending(), 2)
+        self.assertEqual(dispatcher.dispatch_pending(), 1)
+        self.assertEqual(dispatcher.dispatch_pending(), 0)
+
+        self.assertEqual([c[0][0] for c in publisher.publish.call_args_list], [str(c.uuid) for c in commands])
+        pending = CommandMessage.objects.filter(dispatch_status=CommandMessage.DISPATCH_PENDING)
+        self.assertFalse(pending.exists())
+
+    def test_commands_stay_pending_when_broker_is_down(self):
+        command = self._create_command()
+        publisher = mock.Mock()
+        publisher.publish.side_effect = BrokerUnavailableError()
+        dispatcher = OutboxDispatcher(publisher=publisher)
+
+        self.assertEqual(dispatcher.dispatch_pending(), 0)
+        command.refresh_from_db()
+        self.assertEqual(command.dispatch_status, CommandMessage.DISPATCH_PENDING)
+        self.assertEqual(command.dispatch_attempts, 1)
+
+    def test_claimed_commands_are_not_sent_by_other_dispatchers(self):
+        self._create_command()
+        other = OutboxDispatcher(publisher=mock.Mock())
+        publisher = mock.Mock()
+        # Another dispatcher runs while the first one is publishing its batch.
+        publisher.publish.side_effect = lambda correlation_id, body: other.dispatch_pending()
+        dispatcher = OutboxDispatcher(publisher=publisher)
+
+        self.assertEqual(dispatcher.dispatch_pending(), 1)
+        self.assertFalse(other.publisher.publish.called)
+
+    def test_abandoned_claims_are_sent_again(self):
+        command = self._create_command()
+        CommandMessage.objects.filter(uuid=command.uuid).update(
+            dispatch_status=CommandMessage.DISPATCH_IN_FLIGHT, dispatch_token=uuid.uuid4(),
+            date_claimed=timezone.now() - timezone.timedelta(seconds=120))
+        publisher = mock.Mock()
+
+        self.assertEqual(OutboxDispatcher(claim_timeout=300, publisher=publisher).dispatch_pending(), 0)
+        self.assertEqual(OutboxDispatcher(claim_timeout=60, publisher=publisher).dispatch_pending(), 1)
+        command.refresh_from_db()
+        self.assertEqual(command.dispatch_status, CommandMessage.DISPATCH_SENT)
+
+
+class BotReceiverTest(ChatroomTestCase):
+
+    def test_responses_are_saved_in_bulk(self):
+        commands = [CommandMessage.objects.create(date_posted=timezone.now(), user=self.user, request='{}')
+                    for _ in range(3)]
+        responses = [(str(c.uuid), json.dumps({'error': False, 'message': str(i)}).encode())
+                     for i, c in enumerate(commands)]
+        responses.append((str(uuid.uuid4()), b'{}'))
+        responses.append(('not-an-uuid', b'{}'))
+
+        # One lookup and one update, plus the savepoint of the transaction and its release.
+        with self.assertNumQueries(4):
+            BotReceiver.save_responses(responses)
+
+        for i, command in enumerate(commands):
+            command.refresh_from_db()
+            self.assertIsNotNone(command.date_answered)
+            self.assertEqual(json.loads(command.response)['message'], str(i))
+
+    def test_large_batches_are_saved_in_chunks(self):
+        CommandMessage.objects.bulk_create([CommandMessage(date_posted=timezone.now(), user=self.user,
+                                                           request='{}') for _ in range(400)])
+        responses = [(str(command_uuid), b'{"error": false, "message": "Answer"}')
+                     for command_uuid in CommandMessage.objects.values_list('uuid', flat=True)]
+
+        # Three lookups and three updates of up to 150 commands, so SQLite's limit of 999 parameters in
+        # a query is not reached.
+        with self.assertNumQueries(8):
+            BotReceiver.save_responses(responses)
+
+        self.assertEqual(CommandMessage.objects.filter(date_answered__isnull=False).count(), 400)
+
+    def test_responses_are_rendered_when_received(self):
+        command = CommandMessage.objects.create(date_posted=timezone.now(), user=self.user,
+                                                request='{"type": "day_range", "arg": ["A", "B"]}')
+        results = [{'error': False, 'message': 'A range'}, {'error': True, 'message': 'B not found'}]
+        BotReceiver.save_responses([(str(command.uuid), json.dumps({'error': False, 'results': results})
+                                     .encode())])
+
+        command.refresh_from_db()
+        self.assertEqual([(m['text'], m['error']) for m in json.loads(command.rendered)],
+                         [('A range', False), ('B not found', True)])
+
+        # The stored messages are sent as they are.
+        with mock.patch('chatroom.restapi.render_reply') as render_reply:
+            response = self.client.get(reverse('updates'))
+        self.assertFalse(render_reply.called)
+        self.assertEqual([m['text'] for m in json.loads(response.content.decode())],
+                         ['A range', 'B not found'])
+
+
+class NotificationHubTest(TestCase):
+
+    def test_wait_returns_when_notified(self):
+        hub = NotificationHub()
+        version = hub.version(1)
+        threading.Timer(0.05, hub.notify_user, args=([1],)).start()
+        self.assertTrue(hub.wait(1, version, 5))
+
+    def test_other_users_are_not_woken_up(self):
+        hub = NotificationHub()
+        version = hub.version(1)
+        hub.notify_user([2])
+        self.assertFalse(hub.wait(1, version, 0.05))
+        hub.notify_message()
+        self.assertTrue(hub.wait(1, version, 0))
+
+    def test_changes_of_other_processes_are_found_in_the_database(self):
+        state = [(1, 1, None)]
+        hub = NotificationHub(check_interval=0.01, database_state=lambda: state[0])
+        version = hub.version(1)
+        hub.check_database()
+        self.assertFalse(hub.wait(1, version, 0.05))
+        # A message posted by another process.
+        state[0] = (2, 1, None)
+        self.assertTrue(hub.wait(1, version, 5))
+
+    def test_answers_of_other_processes_only_wake_up_their_users(self):
+        state = [(1, 1, 10)]
+        answered_after = []
+
+        def answered_users(date_answered):
+            answered_after.append(date_answered)
+            return {2}
+
+        hub = NotificationHub(check_interval=0.01, database_state=lambda: state[0],
+                              answered_users=answered_users)
+        versions = hub.version(1), hub.version(2)
+        hub.check_database()
+        # An answer for user 2 saved by another process.
+        state[0] = (1, 1, 20)
+        self.assertTrue(hub.wait(2, versions[1], 5))
+        self.assertFalse(hub.wait(1, versions[0], 0.05))
+        self.assertEqual(answered_after, [10])
+
+    def test_answered_users_after_a_date(self):
+        other = get_user_model().objects.create_user('other', password='secret1234567')
+        users = get_user_model().objects.create_user('tester', password='secret1234567'), other
+        now = timezone.now()
+        for i, user in enumerate(users):
+            CommandMessage.objects.create(date_posted=now, user=user, request='{}',
+                                          date_answered=now + timezone.timedelta(seconds=i))
+
+        self.assertEqual(get_answered_users(None), {u.id for u in users})
+        self.assertEqual(get_answered_users(now), {other.id})
+
+
+class LongPollUpdatesTest(ChatroomTestCase):
+
+    def test_waits_for_new_messages(self):
+        last_t = timezone.now().isoformat()
+
+        def post_message(user_id, version, timeout):
+            Message.objects.create(user=self.user, date_posted=timezone.now(), text='Hello')
+            return True
+
+        with mock.patch('chatroom.restapi.hub.wait', side_effect=post_message) as wait:
+            response = self.client.get(reverse('updates'), {'last_t': last_t, 'wait': 60})
+
+        self.assertEqual(wait.call_args[0][2], 25)
+        self.assertEqual([m['text'] for m in json.loads(response.content.decode())], ['Hello'])
+
+    def test_does_not_wait_when_there_are_updates(self):
+        last_t = timezone.now().isoformat()
+        Message.objects.create(user=self.user, date_posted=timezone.now(), text='Hello')
+
+        with mock.patch('chatroom.restapi.hub.wait') as wait:
+            response = self.client.get(reverse('updates'), {'last_t': last_t, 'wait': 10})
+
+        self.assertFalse(wait.called)
+        self.assertEqual(len(json.loads(response.content.decode())), 1)
+
+    def test_timestamp_without_offset(self):
+        recent_messages.warm()
+        Message.objects.create(user=self.user, date_posted=timezone.now(), text='Hello')
+        last_t = timezone.localtime(timezone.now() - timezone.timedelta(minutes=1)).replace(tzinfo=None)
+
+        response = self.client.get(reverse('updates'), {'last_t': last_t.isoformat()})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['text'] for m in json.loads(response.content.decode())], ['Hello'])
+
+
+class MessageStreamTest(ChatroomTestCase):
+
+    def _read_events(self, response, count):
+        content = iter(response.streaming_content)
+        events = [next(content).decode() for _ in range(count)]
+        response.close()
+        return events
+
+    def test_resumes_from_last_event_id(self):
+        first = Message.objects.create(user=self.user, date_posted=timezone.now(), text='First')
+        second = Message.objects.create(user=self.user, date_posted=timezone.now(), text='Second')
+
+        with mock.patch('chatroom.restapi.hub.wait', return_value=False):
+            response = self.client.get(reverse('stream'), HTTP_LAST_EVENT_ID=str(first.id))
+            retry, messages, heartbeat = self._read_events(response, 3)
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(retry.startswith('retry:'))
+        self.assertTrue(messages.startswith('id: {0}\n'.format(second.id)))
+        self.assertEqual(json.loads(messages.split('data: ')[1])['text'], 'Second')
+        self.assertEqual(heartbeat, ': heartbeat\n\n')
+
+    def test_sends_bot_replies(self):
+        CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock", "arg": "AAPL"}',
+                                      user=self.user, date_answered=timezone.now(),
+                                      response='{"error": false, "message": "AAPL quote is $1.00"}')
+
+        with mock.patch('chatroom.restapi.hub.wait', return_value=False):
+            response = self.client.get(reverse('stream'))
+            events = self._read_events(response, 2)
+
+        # All the messages of an answer are sent in one event.
+        self.assertEqual([m['text'] for m in json.loads(events[1][len('data: '):])], ['AAPL quote is $1.00'])
+        self.assertFalse(CommandMessage.objects.filter(read=False).exists())
+
+
+class QueryCountTest(ChatroomTestCase):
+    """The number of queries of the read endpoints must not depend on the number of messages."""
+
+    def setUp(self):
+        super(QueryCountTest, self).setUp()
+        self.users = [get_user_model().objects.create_user('user{0}'.format(i)) for i in range(3)]
+
+    def _create_messages(self, count):
+        for i in range(count):
+            Message.objects.create(user=self.users[i % len(self.users)], date_posted=timezone.now(),
+                                   text=str(i))
+
+    def _create_replies(self, count):
+        for i in range(count):
+            CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock", "arg": "A"}',
+                                          user=self.user, date_answered=timezone.now(),
+                                          response='{"error": false, "message": "A quote"}')
+
+    def test_last_messages(self):
+        for count in (1, 30):
+            Message.objects.all().delete()
+            self._create_messages(count)
+            # Session, user, and the last messages loaded in the buffer.
+            with self.assertNumQueries(3):
+                response = self.client.get(reverse('last-n'), {'count': 50})
+            self.assertEqual(len(json.loads(response.content.decode())), count)
+
+    def test_updates(self):
+        last_t = timezone.now().isoformat()
+
+        for count in (1, 30):
+            self._create_messages(count)
+            self._create_replies(count)
+            # Session, user, the last messages loaded in the buffer, marking the unread replies as read and
+            # reading them.
+            with self.assertNumQueries(5):
+                response = self.client.get(reverse('updates'), {'last_t': last_t})
+            self.assertEqual(len(json.loads(response.content.decode())), count * 2)
+            last_t = json.loads(response.content.decode())[count - 1]['timestamp']
+
+
+class MessageHistoryTest(ChatroomTestCase):
+
+    def setUp(self):
+        super(MessageHistoryTest, self).setUp()
+        # Messages with the same date must not be skipped or repeated between pages.
+        now = timezone.now()
+        self.ids = [Message.objects.create(user=self.user, date_posted=now, text=str(i)).id for i in range(5)]
+
+    def _get_page(self, **params):
+        response = self.client.get(reverse('history'), dict(params, count=2))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_pages_backwards_and_forwards(self):
+        page = self._get_page()
+        seen = [m['id'] for m in page['messages']]
+        newest_cursor = page['after']
+
+        while page['before']:
+            page = self._get_page(before=page['before'])
+            seen = [m['id'] for m in page['messages']] + seen
+
+        self.assertEqual(seen, self.ids)
+
+        page = self._get_page(after=self._get_page(before=newest_cursor)['after'])
+        self.assertEqual([m['id'] for m in page['messages']], self.ids[-1:])
+        self.assertEqual(self._get_page(after=newest_cursor), {'messages': [], 'before': newest_cursor,
+                                                               'after': newest_cursor})
+
+        newer = Message.objects.create(user=self.user, date_posted=timezone.now(), text='New')
+        page = self._get_page(after=newest_cursor)
+        self.assertEqual([m['id'] for m in page['messages']], [newer.id])
+
+    def test_cursor_is_a_range_on_the_date(self):
+        cursor = self._get_page()['before']
+
+        for params in ({'before': cursor}, {'after': cursor}):
+            with CaptureQueriesContext(connection) as queries:
+                self._get_page(**params)
+            sql = [q['sql'] for q in queries if 'chatroom_message' in q['sql']][-1]
+            self.assertNotIn(' OR ', sql)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('history'), {'before': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+
+
+class RecentMessagesTest(ChatroomTestCase):
+
+    def setUp(self):
+        super(RecentMessagesTest, self).setUp()
+        self.now = 0
+
+    def _create_message(self, text, date_posted=None):
+        return Message.objects.create(user=self.user, date_posted=date_posted or timezone.now(), text=text)
+
+    def _create_buffer(self, size):
+        buffer = RecentMessages(size=size, max_age=10, clock=lambda: self.now)
+        buffer.warm()
+        return buffer
+
+    def test_last_messages_are_served_from_memory(self):
+        for i in range(5):
+            self._create_message(str(i))
+        buffer = self._create_buffer(3)
+
+        with self.assertNumQueries(0):
+            self.assertEqual([m['text'] for m in buffer.last(2)], ['3', '4'])
+        self.assertIsNone(buffer.last(4))
+
+        buffer.add(self._create_message('5'))
+        self.assertEqual([m['text'] for m in buffer.last(3)], ['3', '4', '5'])
+
+    def test_messages_of_other_processes_are_loaded_after_max_age(self):
+        buffer = self._create_buffer(10)
+        self._create_message('Other process')
+        self.assertEqual(buffer.last(10), [])
+
+        self.now = 10
+        self.assertEqual([m['text'] for m in buffer.last(10)], ['Other process'])
+
+    def test_messages_committed_late_are_loaded(self):
+        first = self._create_message('First')
+        buffer = self._create_buffer(10)
+        # A message with a greater id is already in the buffer when an older one is committed.
+        buffer.add(self._create_message('Third'))
+        Message.objects.filter(id=first.id).update(text='Second', date_posted=timezone.now())
+        self._create_message('First', date_posted=first.date_posted)
+
+        self.now = 10
+        self.assertEqual([m['text'] for m in buffer.last(10)], ['First', 'Third', 'Second'])
+
+    def test_messages_since(self):
+        first = self._create_message('First')
+        buffer = self._create_buffer(2)
+        self.assertEqual([m['text'] for m in buffer.since(first.date_posted, 100)], [])
+
+        buffer.add(self._create_message('Second'))
+        buffer.add(self._create_message('Third'))
+        # "First" was dropped, so the messages before it could be missing.
+        self.assertIsNone(buffer.since(first.date_posted - timezone.timedelta(seconds=1), 100))
+        self.assertEqual([m['text'] for m in buffer.since(first.date_posted, 100)], ['Second', 'Third'])
+
+    def test_database_is_read_without_holding_the_lock(self):
+        self._create_message('First')
+        buffer = self._create_buffer(10)
+        self._create_message('Other process')
+        self.now = 10
+        locked = []
+
+        def record(method):
+            def wrapper(queryset, *args, **kwargs):
+                locked.append(buffer._lock.locked())
+                return method(queryset, *args, **kwargs)
+            return wrapper
+
+        with mock.patch.object(QuerySet, '_fetch_all', record(QuerySet._fetch_all)):
+            self.assertEqual([m['text'] for m in buffer.last(10)], ['First', 'Other process'])
+        self.assertTrue(locked)
+        self.assertNotIn(True, locked)
+
+
+class ConditionalGetTest(ChatroomTestCase):
+
+    def _assert_not_modified_until_changed(self, url, change, params=None):
+        response = self.client.get(url, params or {})
+        etag = response['ETag']
+
+        response = self.client.get(url, params or {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        change()
+        response = self.client.get(url, params or {}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def _post_message(self):
+        self.client.post(reverse('post'), {'message': 'Hello'})
+
+    def test_last_messages(self):
+        self._assert_not_modified_until_changed(reverse('last-n'), self._post_message)
+
+    def test_updates_are_not_conditional(self):
+        def answer_command(text):
+            CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock", "arg": "A"}',
+                                          user=self.user, date_answered=timezone.now(),
+                                          response='{{"error": false, "message": "{0}"}}'.format(text))
+
+        params = {'last_t': timezone.now().isoformat()}
+        answer_command('First')
+        response = self.client.get(reverse('updates'), params)
+        self.assertEqual([m['text'] for m in json.loads(response.content.decode())], ['First'])
+        self.assertFalse(response.has_header('ETag'))
+
+        # Delivered answers must not be shown again from the cache, and new ones must not be hidden.
+        answer_command('Second')
+        response = self.client.get(reverse('updates'), params, HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertEqual([m['text'] for m in json.loads(response.content.decode())], ['Second'])
+
+    def test_online_users(self):
+        def login_other_user():
+            other = get_user_model().objects.create_user('other', password='secret1234567')
+            self.client_class().force_login(other)
+
+        self._assert_not_modified_until_changed(reverse('onlineusers'), login_other_user)
+
+
+class PresenceTest(ChatroomTestCase):
+
+    def _online_users(self):
+        response = self.client.get(reverse('onlineusers'))
+        return [user['id'] for user in json.loads(response.content.decode())]
+
+    def test_users_online_until_timeout(self):
+        other = get_user_model().objects.create_user('other', password='secret1234567')
+        self.client_class().force_login(other)
+        self.assertEqual(self._online_users(), [other.id])
+
+        Presence.objects.filter(user=other).update(last_seen=timezone.now() - timezone.timedelta(minutes=5))
+        self.assertEqual(self._online_users(), [])
+
+    def test_logout_removes_user(self):
+        other = get_user_model().objects.create_user('other', password='secret1234567')
+        other_client = self.client_class()
+        other_client.force_login(other)
+        other_client.get(reverse('logout'))
+        self.assertEqual(self._online_users(), [])
+
+    def test_heartbeats_are_throttled(self):
+        presence_tracker.clear()
+        self.client.get(reverse('onlineusers'))
+        last_seen = Presence.objects.get(user=self.user).last_seen
+
+        # Session, user, expired users, version and online users. The presence of the user was just saved.
+        with self.assertNumQueries(5):
+            self.client.get(reverse('onlineusers'), HTTP_IF_NONE_MATCH='"any"')
+        self.assertEqual(Presence.objects.get(user=self.user).last_seen, last_seen)
+
+
+class PresenceChangesTest(ChatroomTestCase):
+
+    def _get_changes(self, version=None):
+        params = {'version': version} if version is not None else {}
+        response = self.client.get(reverse('onlineusers-changes'), params)
+        return json.loads(response.content.decode())
+
+    def _login(self, username):
+        user = get_user_model().objects.create_user(username, password='secret1234567')
+        client = self.client_class()
+        client.force_login(user)
+        return user, client
+
+    def test_changes_since_version(self):
+        first, first_client = self._login('first')
+        snapshot = self._get_changes()
+        self.assertTrue(snapshot['full'])
+        self.assertEqual([u['id'] for u in snapshot['joined']], [first.id])
+
+        second, _ = self._login('second')
+        first_client.get(reverse('logout'))
+        changes = self._get_changes(snapshot['version'])
+        self.assertEqual((changes['full'], [u['id'] for u in changes['joined']], changes['left']),
+                         (False, [second.id], [first.id]))
+
+        self.assertEqual(self._get_changes(changes['version']),
+                         {'version': changes['version'], 'full': False, 'joined': [], 'left': []})
+
+    def test_expired_users_leave(self):
+        other, _ = self._login('other')
+        version = self._get_changes()['version']
+        Presence.objects.filter(user=other).update(last_seen=timezone.now() - timezone.timedelta(minutes=5))
+        self.assertEqual(self._get_changes(version)['left'], [other.id])
+
+    def test_users_seen_while_expiring_dont_leave(self):
+        other, _ = self._login('other')
+        Presence.objects.filter(user=other).update(last_seen=timezone.now() - timezone.timedelta(minutes=5))
+        atomic = transaction.atomic
+
+        def request_of_other_user(*args, **kwargs):
+            # The user makes a request after the expired users were read, and before they are updated.
+            Presence.objects.filter(user=other).update(last_seen=timezone.now())
+            return atomic(*args, **kwargs)
+
+        with mock.patch('chatroom.presence.transaction', atomic=request_of_other_user,
+                        on_commit=transaction.on_commit):
+            self.assertIn(other.id, presence_tracker.online_user_ids())
+        self.assertFalse(PresenceEvent.objects.filter(user=other, joined=False).exists())
+
+    def test_old_versions_get_the_full_list(self):
+        other, _ = self._login('other')
+        version = self._get_changes()['version']
+
+        with mock.patch.object(presence_tracker, 'max_changes', 1):
+            self._login('second')
+            self._login('third')
+            changes = self._get_changes(version)
+
+        self.assertTrue(changes['full'])
+        self.assertEqual(len(changes['joined']), 3)
+
+
+class SyncTest(ChatroomTestCase):
+
+    def _sync(self, **params):
+        response = self.client.get(reverse('sync'), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode())
+
+    def test_returns_messages_replies_and_presence(self):
+        first = self._sync()
+        self.assertEqual(first['messages'], [])
+        self.assertTrue(first['presence']['full'])
+
+        message = Message.objects.create(user=self.user, date_posted=timezone.now(), text='Hello')
+        CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock", "arg": "A"}',
+                                      user=self.user, date_answered=timezone.now(),
+                                      response='{"error": false, "message": "A quote"}')
+        other = get_user_model().objects.create_user('other', password='secret1234567')
+        self.client_class().force_login(other)
+
+        result = self._sync(after=first['cursor'], presence=first['presence']['version'])
+        self.assertEqual([m['text'] for m in result['messages']], ['Hello'])
+        self.assertEqual(result['cursor'], message.id)
+        self.assertEqual([r['text'] for r in result['replies']], ['A quote'])
+        self.assertEqual([u['id'] for u in result['presence']['joined']], [other.id])
+
+    def test_waits_when_there_is_nothing_new(self):
+        first = self._sync()
+
+        def post_message(user_id, version, timeout):
+            Message.objects.create(user=self.user, date_posted=timezone.now(), text='Hello')
+            return True
+
+        with mock.patch('chatroom.restapi.hub.wait', side_effect=post_message) as wait:
+            result = self._sync(after=first['cursor'], presence=first['presence']['version'], wait=10)
+
+        self.assertTrue(wait.called)
+        self.assertEqual([m['text'] for m in result['messages']], ['Hello'])
+
+
+class ClaimRepliesTest(ChatroomTestCase):
+
+    def _answer_command(self, text):
+        response = '{{"error": false, "message": "{0}"}}'.format(text)
+        return CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock"}',
+                                             user=self.user, date_answered=timezone.now(), response=response)
+
+    def _get_replies(self):
+        response = self.client.get(reverse('updates'))
+        return [m['text'] for m in json.loads(response.content.decode())]
+
+    def test_replies_are_sent_once(self):
+        self._answer_command('First')
+        self.assertEqual(self._get_replies(), ['First'])
+        self.assertEqual(self._get_replies(), [])
+
+    def test_reply_saved_while_sending_is_not_lost(self):
+        from .replies import render_reply
+
+        self._answer_command('First')
+
+        def answer_while_rendering(request, response, date_answered):
+            if not CommandMessage.objects.filter(read=False).exists():
+                self._answer_command('Second')
+            return render_reply(request, response, date_answered)
+
+        with mock.patch('chatroom.restapi.render_reply', side_effect=answer_while_rendering):
+            self.assertEqual(self._get_replies(), ['First'])
+        self.assertEqual(self._get_replies(), ['Second'])
+
+
+class RetentionPolicyTest(ChatroomTestCase):
+
+    def setUp(self):
+        super(RetentionPolicyTest, self).setUp()
+        old = timezone.now() - timezone.timedelta(days=100)
+        for i in range(5):
+            Message.objects.create(user=self.user, date_posted=old, text='Old {0}'.format(i))
+        Message.objects.create(user=self.user, date_posted=timezone.now(), text='New')
+        for read in (True, False):
+            CommandMessage.objects.create(date_posted=old, request='{"type": "stock"}', user=self.user,
+                                          read=read)
+        CommandMessage.objects.create(date_posted=timezone.now(), request='{"type": "stock"}',
+                                      user=self.user, read=True)
+
+    def test_dry_run_changes_nothing(self):
+        result = RetentionPolicy(batch_size=2).run(dry_run=True)
+        self.assertEqual(result, {'commands': 1, 'messages': 5})
+        self.assertEqual(Message.objects.count(), 6)
+        self.assertEqual(CommandMessage.objects.count(), 3)
+        self.assertFalse(ArchivedMessage.objects.exists())
+
+    def test_old_data_is_removed_in_batches(self):
+        old_ids = list(Message.objects.filter(text__startswith='Old').values_list('id', flat=True))
+
+        with mock.patch.object(RetentionPolicy, '_archive_messages',
+                               side_effect=RetentionPolicy._archive_messages, autospec=True) as archive:
+            result = RetentionPolicy(batch_size=2).run()
+
+        self.assertEqual(result, {'commands': 1, 'messages': 5})
+        self.assertEqual(archive.call_count, 3)
+        self.assertEqual(list(Message.objects.values_list('text', flat=True)), ['New'])
+        self.assertEqual(sorted(ArchivedMessage.objects.values_list('id', flat=True)), sorted(old_ids))
+        # Commands whose answer was not sent yet are kept.
+        self.assertFalse(CommandMessage.objects.filter(read=True, date_posted__lt=timezone.now()
+                                                       - timezone.timedelta(days=7)).exists())
+        self.assertEqual(CommandMessage.objects.count(), 2)
+
+    def test_invalid_batch_size(self):
+        for batch_size in (0, -1):
+            with self.assertRaises(CommandError):
+                call_command('prune_chat_data', batch_size=batch_size, stdout=io.StringIO())
+        self.assertEqual(Message.objects.count(), 6)
@@ -2,9 +2,9 @@
 
 """Utility functions."""
 
-import logging
+import base64, binascii, logging
 
-from django.utils import dateparse, formats
+from django.utils import dateparse, formats, timezone
 
 logger = logging.getLogger('chatroom')
 
@@ -18,6 +18,46 @@ def datetime_aware_to_str(timestamp):
 
 
 def str_to_datetime_aware(timestamp_str):
+    """
+    Returns the datetime of a string in ISO 8601 format, or None if the format is not valid. Dates without
+    offset are taken in the current time zone, like the ORM does.
+    """
     if timestamp_str is None:
         return None
-    return dateparse.parse_datetime(timestamp_str)
+
+    timestamp = dateparse.parse_datetime(timestamp_str)
+
+    if timestamp is not None and timezone.is_naive(timestamp):
+        try:
+            timestamp = timezone.make_aware(timestamp)
+        except Exception as e:
+            # Dates that don't exist, or are ambiguous, because of a daylight saving time change.
+            raise ValueError('Invalid date: {0}'.format(timestamp_str)) from e
+
+    return timestamp
+
+
+def encode_cursor(date_posted, message_id):
+    """Returns an opaque cursor pointing to the position of a message in the history."""
+    value = '{0}|{1}'.format(date_posted.isoformat(), message_id)
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the (date_posted, message_id) tuple of a cursor. Raises ValueError if it is not valid."""
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        date_str, message_id = value.split('|')
+        date_posted = str_to_datetime_aware(date_str)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+    if date_posted is None:
+        raise ValueError('Invalid cursor.')
+    return date_posted, int(message_id)
+
+
+def join_json_arrays(arrays):
+    """Returns a JSON array with the elements of all the given JSON arrays, without decoding them."""
+    elements = [array.strip()[1:-1].strip() for array in arrays]
+    return '[' + ', '.join(element for element in elements if element) + ']'
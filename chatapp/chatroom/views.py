@@ -1,13 +1,16 @@
 # encoding: utf-8
 
-import json
+import hashlib, json
 
-from django.http import HttpResponseForbidden, HttpResponseRedirect, JsonResponse
+from django.http import HttpResponseForbidden, HttpResponseNotModified, HttpResponseRedirect, JsonResponse
+from django.http.response import HttpResponseBase
 from django.contrib.auth import authenticate, login, logout
 from django.core.urlresolvers import reverse
+from django.utils.http import parse_etags, quote_etag
 from django.views.generic import TemplateView
 from django.views.generic import View
 
+from chatroom.presence import presence_tracker
 from chatroom.utils import logger
 
 
@@ -21,6 +24,14 @@ class AjaxView(View):
         if self.requires_authentication and not request.user.is_authenticated():
             return AjaxView._create_forbidden_response()
 
+        if request.user.is_authenticated():
+            try:
+                presence_tracker.heartbeat(request.user)
+            except Exception as e:
+                # The request can be answered anyway.
+                logger.error('Error updating the presence of the user.')
+                logger.exception(e)
+
         if request.method.lower() in self.http_method_names:
             handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
         else:
@@ -37,12 +48,13 @@ class AjaxView(View):
             return AjaxView.create_error_response('Error processing request. Please take a look at the '
                                                   'application log for more details.')
 
-        # Make sure the response is in json format. If not, try to convert it to json.
+        # Make sure the response is in json format. If not, try to convert it to json. Other kinds of
+        # responses, like streams of events, are returned as they are.
         if response is None:
             logger.warn('Null response for "{0} {1}", class {2}'.format(request.method, request.path,
                                                                         self.__class__.__name__))
             response = JsonResponse('', safe=False)
-        elif not isinstance(response, JsonResponse):
+        elif not isinstance(response, HttpResponseBase):
             try:
                 response = JsonResponse(response, safe=False)
             except Exception as e:
@@ -52,6 +64,28 @@ class AjaxView(View):
 
         return response
 
+    @staticmethod
+    def make_etag(*parts):
+        """Returns an ETag made from the values that identify the version of a response."""
+        return hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+    @staticmethod
+    def conditional_response(request, etag, create_response):
+        """
+        Returns a 304 response if the browser already has the version of the response identified by etag.
+        Otherwise, the response is created by calling create_response. The browser must validate the
+        response with the server every time it is used.
+        """
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+        else:
+            response = create_response()
+
+        if response.status_code in (200, 304):
+            response['ETag'] = quote_etag(etag)
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
     @staticmethod
     def _create_forbidden_response():
         json_response = json.dumps({'error': True, 'message': 'Forbidden'})
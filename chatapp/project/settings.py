@@ -92,6 +92,75 @@ USE_TZ = True
 
 STATIC_URL = '/assets/'
 
+# Connection to RabbitMQ, used to exchange messages with the bot.
+CHATROOM_BROKER = {
+    'HOST': 'localhost',
+    'REQUESTS_QUEUE': 'bot_requests',
+    'RESPONSES_QUEUE': 'bot_responses',
+    # Seconds a request waits for the connection to RabbitMQ.
+    'CONNECT_TIMEOUT': 2,
+    # Seconds during which commands fail immediately after RabbitMQ was found unavailable.
+    'RETRY_INTERVAL': 5,
+}
+
+# Responses of the bot are saved in batches of up to BATCH_SIZE, waiting at most BATCH_TIMEOUT seconds.
+# With RUN_IN_PROCESS = False, the web processes don't consume the responses, and they must be consumed
+# with "manage.py run_bot_receiver".
+CHATROOM_RECEIVER = {
+    'RUN_IN_PROCESS': True,
+    'BATCH_SIZE': 50,
+    'BATCH_TIMEOUT': 0.2,
+}
+
+# Commands are saved as pending in the database and sent to the bot by a background dispatcher.
+CHATROOM_OUTBOX = {
+    'RUN_IN_PROCESS': True,
+    'BATCH_SIZE': 100,
+    'POLL_INTERVAL': 2,
+    'CLAIM_TIMEOUT': 60,
+}
+
+# Requests for updates can wait for new messages instead of returning an empty list. Every waiting request
+# holds a server thread, so use a threaded or asynchronous server when it is enabled.
+CHATROOM_LONG_POLL = {
+    'MAX_WAIT': 25,
+    'CHECK_INTERVAL': 1,
+}
+
+# Number of recent messages kept in memory to answer the requests for the last messages and updates.
+CHATROOM_MESSAGE_BUFFER = {
+    'SIZE': 200,
+    'MAX_AGE': 1,
+}
+
+# Users are online while they made a request in the last TIMEOUT seconds. Their last request date is
+# saved at most every HEARTBEAT_INTERVAL seconds. Browsers with a version of the online users older than
+# EVENTS_RETENTION seconds, or more than MAX_CHANGES changes behind, get the full list.
+CHATROOM_PRESENCE = {
+    'TIMEOUT': 30,
+    'HEARTBEAT_INTERVAL': 10,
+    'EVENTS_RETENTION': 3600,
+    'MAX_CHANGES': 100,
+}
+
+# Server-Sent Events stream of messages. It also holds a server thread for every connected browser.
+CHATROOM_STREAM = {
+    'HEARTBEAT': 15,
+    'MAX_DURATION': 300,
+    # Milliseconds the browser waits before reconnecting.
+    'RETRY': 3000,
+}
+
+# Delivered commands and old messages are removed by "manage.py prune_chat_data", or periodically by a
+# thread of the process if RUN_IN_PROCESS is enabled.
+CHATROOM_RETENTION = {
+    'RUN_IN_PROCESS': False,
+    'INTERVAL': 3600,
+    'COMMANDS_MAX_AGE_DAYS': 7,
+    'MESSAGES_MAX_AGE_DAYS': 90,
+    'BATCH_SIZE': 500,
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -15,6 +15,10 @@ urlpatterns = [
     # API de mensajes para el chat
     url(r'^messages/post$', rest_views.PostMessage.as_view(), name='post'),
     url(r'^messages/list$', rest_views.GetLastMessages.as_view(), name='last-n'),
+    url(r'^messages/history$', rest_views.MessageHistory.as_view(), name='history'),
     url(r'^messages/updates$', rest_views.GetUpdates.as_view(), name='updates'),
-    url(r'^misc/onlineusers$', rest_views.GetOnlineUsers.as_view(), name='onlineusers')
+    url(r'^messages/stream$', rest_views.MessageStream.as_view(), name='stream'),
+    url(r'^sync$', rest_views.Sync.as_view(), name='sync'),
+    url(r'^misc/onlineusers$', rest_views.GetOnlineUsers.as_view(), name='onlineusers'),
+    url(r'^misc/onlineusers/changes$', rest_views.GetOnlineUserChanges.as_view(), name='onlineusers-changes'),
 ]